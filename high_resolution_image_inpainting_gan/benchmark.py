@@ -0,0 +1,266 @@
+import argparse
+import json
+import platform
+import resource
+import time
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import torch
+import yaml
+from addict import Dict as Adict
+from albumentations.core.serialization import from_dict
+from iglovikov_helper_functions.config_parsing.utils import object_from_dict
+from torch import nn
+
+from high_resolution_image_inpainting_gan.dataset import (
+    IMAGE_EXTENSIONS,
+    InpaintDataset,
+)
+from high_resolution_image_inpainting_gan.losses import Perceptual
+from high_resolution_image_inpainting_gan.masks import StrokeMaskGenerator
+
+MODEL_COMPONENTS = ["generator", "coarse", "discriminator", "perceptual"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-c", "--config_path", type=Path, help="Path to the config.", required=True)
+    arg(
+        "--components",
+        nargs="+",
+        choices=MODEL_COMPONENTS + ["dataset"],
+        help="Components to benchmark, dataset requires image_path.",
+        default=MODEL_COMPONENTS,
+    )
+    arg("-r", "--resolutions", nargs="+", type=int, help="Image sizes.", default=[256, 512])
+    arg("-b", "--batch_sizes", nargs="+", type=int, help="Batch sizes.", default=[1, 8])
+    arg(
+        "--devices",
+        nargs="+",
+        help="Devices to run on.",
+        default=["cpu", "cuda"] if torch.cuda.is_available() else ["cpu"],
+    )
+    arg("--num_warmup", type=int, help="Number of iterations before measurements.", default=2)
+    arg("--num_iterations", type=int, help="Number of measured iterations.", default=10)
+    arg("--train", action="store_true", help="Measure forward + backward instead of inference.")
+    arg(
+        "--checkpoint_segments",
+        action="store_true",
+        help="With --train measure the generator with and without activation checkpointing.",
+    )
+    arg("-i", "--image_path", type=Path, help="Path to the folder with images for the dataset benchmark.")
+    arg("-o", "--output_path", type=Path, help="Path to save results, json file.", default="benchmark.json")
+    return parser.parse_args()
+
+
+def count_flops(model: nn.Module, step: Callable[[], torch.Tensor]) -> int:
+    """Floating point operations of Conv2d and Linear layers in one forward, attention matmuls are not included."""
+    flops = 0
+
+    def hook(module: nn.Module, inputs: Any, output: torch.Tensor) -> None:
+        nonlocal flops
+        if isinstance(module, nn.Conv2d):
+            kernel_size = module.kernel_size[0] * module.kernel_size[1]
+            flops += 2 * output.numel() * module.in_channels // module.groups * kernel_size
+        else:
+            flops += 2 * output.numel() * module.in_features
+
+    handles = [x.register_forward_hook(hook) for x in model.modules() if isinstance(x, (nn.Conv2d, nn.Linear))]
+
+    with torch.no_grad():
+        step()
+
+    for handle in handles:
+        handle.remove()
+
+    return flops
+
+
+def synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def get_peak_memory(device: torch.device) -> float:
+    """MB allocated by tensors on cuda, on cpu max resident set size of the process, see benchmark_case."""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def summarize(latencies: List[float], batch_size: int) -> Dict[str, float]:
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "images_per_second": float(batch_size / np.mean(latencies)),
+        "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "latency_p90_ms": float(np.percentile(latencies_ms, 90)),
+        "latency_p99_ms": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def build_model(component: str, config: Adict) -> nn.Module:
+    if component in {"generator", "coarse"}:
+        return object_from_dict(config["generator"])
+    if component == "discriminator":
+        return object_from_dict(config["discriminator"])
+    return Perceptual()
+
+
+def get_step(
+    component: str, model: nn.Module, batch_size: int, resolution: int, device: torch.device, train: bool
+) -> Callable[[], torch.Tensor]:
+    generator = torch.Generator(device=device)
+    generator.manual_seed(0)
+
+    image = torch.rand(batch_size, 3, resolution, resolution, generator=generator, device=device)
+    mask = StrokeMaskGenerator()(batch_size, resolution, resolution, device, generator)
+
+    if component == "generator":
+        return lambda: model(image, mask)[1]
+
+    if component == "coarse":
+        return lambda: model.coarse_forward(image, mask)
+
+    if component == "discriminator":
+        return lambda: model(image, mask)
+
+    # perceptual, with gradients only for the prediction as in training
+    target = torch.rand(batch_size, 3, resolution, resolution, generator=generator, device=device)
+    image.requires_grad_(train)
+    return lambda: model(target, image)
+
+
+def benchmark_model(
+    component: str, model: nn.Module, batch_size: int, resolution: int, device: torch.device, args
+) -> Dict[str, Any]:
+    step = get_step(component, model, batch_size, resolution, device, args.train)
+    flops = count_flops(model, step)
+
+    def run() -> None:
+        if not args.train:
+            with torch.no_grad():
+                step()
+            return
+
+        step().float().mean().backward()
+        model.zero_grad(set_to_none=True)
+
+    for _ in range(args.num_warmup):
+        run()
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    latencies = []
+    for _ in range(args.num_iterations):
+        synchronize(device)
+        start = time.perf_counter()
+        run()
+        synchronize(device)
+        latencies.append(time.perf_counter() - start)
+
+    return {**summarize(latencies, batch_size), "peak_memory_mb": get_peak_memory(device), "gflops": flops / 1e9}
+
+
+def benchmark_case(
+    component: str, model: nn.Module, batch_size: int, resolution: int, device: torch.device, args
+) -> Dict[str, Any]:
+    """benchmark_model, on cpu in a new process: the max resident set size only grows during the life of a process,
+    so every case gets its own, and the peak memory includes the model and the libraries."""
+    if device.type == "cuda":
+        return benchmark_model(component, model, batch_size, resolution, device, args)
+
+    with get_context("spawn").Pool(1) as pool:
+        return pool.apply(benchmark_model, (component, model, batch_size, resolution, device, args))
+
+
+def benchmark_dataset(config: Adict, image_path: Path, num_iterations: int) -> Dict[str, Any]:
+    """Single process decode + augmentations + mask of one sample, as in a dataloader worker."""
+    image_paths = sorted(x for x in image_path.rglob("*") if x.suffix.lower() in IMAGE_EXTENSIONS)
+    dataset = InpaintDataset(image_paths, from_dict(config.train_aug), generate_mask="mask_generator" not in config)
+
+    latencies = []
+    for index in range(num_iterations):
+        start = time.perf_counter()
+        dataset[index % len(dataset)]
+        latencies.append(time.perf_counter() - start)
+
+    return {"component": "dataset", "device": "cpu", **summarize(latencies, 1)}
+
+
+def main():
+    """Throughput, latency, peak memory, parameters and FLOPs of the model components on random inputs."""
+    args = get_args()
+
+    with open(args.config_path) as f:
+        config = Adict(yaml.load(f, Loader=yaml.SafeLoader))
+
+    results = []
+
+    for component in args.components:
+        if component == "dataset":
+            if args.image_path is None:
+                raise ValueError("image_path is required for the dataset benchmark.")
+            results.append(benchmark_dataset(config, args.image_path, args.num_iterations))
+            print(results[-1])
+            continue
+
+        model = build_model(component, config)
+        counted = model.coarse if component == "coarse" else model
+        num_parameters = sum(x.numel() for x in counted.parameters())
+
+        if args.train and args.checkpoint_segments and component in {"generator", "coarse"}:
+            checkpoint_options = [True, False]
+        else:
+            checkpoint_options = [False]
+
+        for device_name in args.devices:
+            device = torch.device(device_name)
+            model.to(device).train(args.train)
+
+            for resolution in args.resolutions:
+                for batch_size in args.batch_sizes:
+                    for checkpoint_segments in checkpoint_options:
+                        if component in {"generator", "coarse"}:
+                            model.checkpoint_segments = checkpoint_segments
+
+                        result = {
+                            "component": component,
+                            "device": device_name,
+                            "resolution": resolution,
+                            "batch_size": batch_size,
+                            "train": args.train,
+                            "checkpoint_segments": checkpoint_segments,
+                            "parameters": num_parameters,
+                        }
+
+                        try:
+                            result.update(benchmark_case(component, model, batch_size, resolution, device, args))
+                        except RuntimeError as e:  # out of memory, or input size not supported by the component
+                            result["error"] = str(e).split("\n")[0]
+
+                        print(result)
+                        results.append(result)
+
+                        if device.type == "cuda":
+                            torch.cuda.empty_cache()
+
+    environment = {
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "processor": platform.processor(),
+        "num_threads": torch.get_num_threads(),
+        "cuda": torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+    }
+
+    args.output_path.parent.mkdir(exist_ok=True, parents=True)
+    with open(args.output_path, "w") as f:
+        json.dump({"environment": environment, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+from typing import Tuple
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from high_resolution_image_inpainting_gan.inpainting_network import GatedGenerator
+
+
+class ContextualResidualAggregation(nn.Module):
+    """
+    Input: high resolution image in range [0, 1] + mask (1 - hole, 0 - non hole)
+    Output: inpainted high resolution image
+
+    The generator only sees a low resolution copy of the image. The low resolution result is upsampled and the
+    missing high frequency details are aggregated from the context residuals (image - blurry image) with the
+    attention scores of the generator, so the cost of the network does not depend on the input resolution.
+    Set `attention_memory_budget` of the generator to aggregate residuals of large images in chunks.
+    """
+
+    def __init__(self, generator: GatedGenerator, low_resolution: int = 512) -> None:
+        super().__init__()
+        self.generator = generator
+        self.low_resolution = low_resolution
+
+    def forward(self, image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        height, width = image.shape[2:]
+        low_size = self.get_low_size(height, width)
+        grid = (low_size[0] // self.generator.patch_size, low_size[1] // self.generator.patch_size)
+
+        # every attention patch should cover the same number of high resolution pixels
+        pad = (0, (-width) % grid[1], 0, (-height) % grid[0])
+        image = F.pad(image, pad, mode="replicate")
+        mask = F.pad(mask, pad, value=0)
+
+        image_low = F.interpolate(image, size=low_size, mode="area")
+        mask_low = F.adaptive_max_pool2d(mask, low_size)  # a low resolution pixel is a hole if any of its pixels is
+
+        high_size = image.shape[2:]
+        blurry = F.interpolate(image_low, size=high_size, mode="bilinear", align_corners=False)
+        residual = (image - blurry) * (1 - mask)  # high frequency details of the context
+
+        # aggregated residuals are zero outside of the holes
+        _, low_out, (aggregated,) = self.generator.forward_with_transfer(image_low, mask_low, [residual])
+        low_out = image_low * (1 - mask_low) + low_out * mask_low
+
+        out = F.interpolate(low_out, size=high_size, mode="bilinear", align_corners=False) + aggregated
+        out = image * (1 - mask) + torch.clamp(out, 0, 1) * mask
+        return out[:, :, :height, :width]
+
+    def get_low_size(self, height: int, width: int) -> Tuple[int, int]:
+        """Keep the aspect ratio, the longest side is `low_resolution`, both sides are multiples of the patch size."""
+        patch_size = self.generator.patch_size
+        scale = self.low_resolution / max(height, width)
+
+        low_height = max(patch_size, round(height * scale / patch_size) * patch_size)
+        low_width = max(patch_size, round(width * scale / patch_size) * patch_size)
+        return low_height, low_width
@@ -0,0 +1,50 @@
+"""Multi-resolution training: the first epochs run at lower resolutions with larger batches.
+
+`curriculum` in the config is a list of stages, every stage has `num_epochs`, `size` and `batch_size`. The stages
+run one after another, after the last one the training continues with `train_aug` and `batch_size` of
+`train_parameters` as without the curriculum.
+
+`without_resize` is the transform of the aspect ratio buckets, see dataset.BucketDataset.
+"""
+
+import copy
+from typing import Any, Dict, List, Optional
+
+RESIZE_KEYS = {"max_size", "height", "width", "min_height", "min_width"}
+
+
+def get_stage(curriculum: List[Dict[str, Any]], epoch: int) -> Optional[Dict[str, Any]]:
+    """Stage of the epoch, None after the last stage."""
+    for stage in curriculum:
+        if epoch < stage["num_epochs"]:
+            return stage
+        epoch -= stage["num_epochs"]
+    return None
+
+
+def resize_transform(transform: Dict[str, Any], size: int) -> Dict[str, Any]:
+    """Copy of the serialized albumentations transform with the sizes of the resizes, crops and pads set to `size`."""
+
+    def update(x: Any) -> None:
+        if isinstance(x, dict):
+            for key, value in x.items():
+                if key in RESIZE_KEYS and isinstance(value, int):
+                    x[key] = size
+                else:
+                    update(value)
+        elif isinstance(x, list):
+            for value in x:
+                update(value)
+
+    result = copy.deepcopy(transform)
+    update(result)
+    return result
+
+
+def without_resize(transform: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of the serialized albumentations Compose without the resizes, crops and pads of the top level."""
+    result = copy.deepcopy(transform)
+    result["transform"]["transforms"] = [
+        x for x in result["transform"]["transforms"] if not RESIZE_KEYS.intersection(x)
+    ]
+    return result
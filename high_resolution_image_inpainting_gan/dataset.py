@@ -1,18 +1,85 @@
+import random
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple, Union
 
 import albumentations as albu
+import cv2
+import numpy as np
 import torch
 from iglovikov_helper_functions.dl.pytorch.utils import tensor_from_rgb_image
 from iglovikov_helper_functions.utils.image_utils import load_rgb
 from iglovikov_helper_functions.utils.inpainting_utils import generate_stroke_mask
 from torch.utils.data import Dataset
 
+IMAGE_EXTENSIONS = {".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".webp"}
+
+
+class MaskBank:
+    """Stroke masks generated by mask_bank.py, bit packed [N, H, W / 8] array.
+
+    The first `num_eval` masks are the evaluation subset: `get` returns them by index without augmentations.
+    `sample` draws one of the other masks with a random rotation / flip.
+    """
+
+    def __init__(self, path: Union[Path, str], num_eval: int = 0) -> None:
+        self.path = Path(path)
+        self.num_eval = num_eval
+        self.masks: Optional[np.ndarray] = None  # memory mapped lazily, in every dataloader worker
+
+        self.num_masks, self.height, packed_width = np.load(self.path, mmap_mode="r").shape
+        self.width = packed_width * 8
+
+        if self.num_masks <= num_eval:
+            raise ValueError(f"num_eval should be less than the number of masks {self.num_masks}, got {num_eval}")
+
+    def __len__(self) -> int:
+        return self.num_masks
+
+    def unpack(self, index: int) -> np.ndarray:
+        if self.masks is None:
+            self.masks = np.load(self.path, mmap_mode="r")
+        return np.unpackbits(self.masks[index], axis=-1).astype(np.float32)
+
+    @staticmethod
+    def resize(mask: np.ndarray, height: int, width: int) -> np.ndarray:
+        if mask.shape == (height, width):
+            return mask
+        return cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+
+    def sample(self, height: int, width: int) -> np.ndarray:
+        mask = self.unpack(random.randint(self.num_eval, self.num_masks - 1))
+
+        if self.height == self.width:
+            mask = np.rot90(mask, random.randint(0, 3))
+        elif random.random() < 0.5:
+            mask = mask[::-1]
+
+        if random.random() < 0.5:
+            mask = mask[:, ::-1]
+
+        return self.resize(np.ascontiguousarray(mask), height, width)
+
+    def get(self, index: int, height: int, width: int) -> np.ndarray:
+        if not self.num_eval:
+            raise ValueError("Mask bank has no evaluation masks, set num_eval.")
+        return self.resize(self.unpack(index % self.num_eval), height, width)
+
 
 class InpaintDataset(Dataset):
-    def __init__(self, image_paths: List[Path], transform: albu.Compose, length: Optional[int] = None) -> None:
+    def __init__(
+        self,
+        image_paths: List[Path],
+        transform: albu.Compose,
+        length: Optional[int] = None,
+        generate_mask: bool = True,
+        mask_bank: Optional[MaskBank] = None,
+        evaluation: bool = False,
+    ) -> None:
         self.image_paths = image_paths
         self.transform = transform
+        self.generate_mask = generate_mask  # False if masks are generated for the whole batch on the device
+        self.mask_bank = mask_bank
+        self.evaluation = evaluation  # the same mask for the same index, from the evaluation subset of the mask bank
 
         if length is None:
             self.length = len(self.image_paths)
@@ -22,9 +89,80 @@ class InpaintDataset(Dataset):
     def __len__(self) -> int:
         return self.length
 
+    def load_image(self, index: int) -> np.ndarray:
+        return load_rgb(self.image_paths[index])
+
+    def get_transform(self, index: int) -> albu.Compose:  # pylint: disable=W0613
+        return self.transform
+
     def __getitem__(self, index: int) -> Dict[str, torch.Tensor]:
-        image = load_rgb(self.image_paths[index])
-        image = self.transform(image=image)["image"]
+        index %= len(self.image_paths)  # `length` can be larger than the number of images
+        image = self.load_image(index)
+        image = self.get_transform(index)(image=image)["image"]
+
+        if not self.generate_mask:
+            return {"image": tensor_from_rgb_image(image)}
+
+        if self.mask_bank is None:
+            mask = generate_stroke_mask((image.shape[1], image.shape[0]))
+        elif self.evaluation:
+            mask = self.mask_bank.get(index, image.shape[0], image.shape[1])
+        else:
+            mask = self.mask_bank.sample(image.shape[0], image.shape[1])
 
-        mask = generate_stroke_mask((image.shape[1], image.shape[0]))
         return {"image": tensor_from_rgb_image(image), "mask": torch.unsqueeze(torch.from_numpy(mask), 0)}
+
+
+class ShardDataset(InpaintDataset):
+    """Reads images packed by pack_shards.py, images are views of memory mapped shards, no decode and no copy."""
+
+    def __init__(
+        self,
+        shard_path: Path,
+        transform: albu.Compose,
+        length: Optional[int] = None,
+        generate_mask: bool = True,
+        mask_bank: Optional[MaskBank] = None,
+    ) -> None:
+        self.index = np.load(shard_path / "index.npy")
+        self.shard_paths = sorted(shard_path.glob("shard_*.bin"))
+        self.shards: Optional[List[np.memmap]] = None  # opened lazily, in every dataloader worker
+        super().__init__(list(range(len(self.index))), transform, length, generate_mask, mask_bank)
+
+    def load_image(self, index: int) -> np.ndarray:
+        if self.shards is None:
+            self.shards = [np.memmap(x, dtype=np.uint8, mode="r") for x in self.shard_paths]
+
+        shard_id, offset, height, width = self.index[index]
+        return self.shards[shard_id][offset : offset + height * width * 3].reshape(height, width, 3)
+
+
+class BucketDataset(InpaintDataset):
+    """Images resized to cover the shape of their aspect ratio bucket and randomly cropped to it, for batches of
+    samplers.AspectRatioBatchSampler. `transform` should not resize or crop."""
+
+    def __init__(
+        self,
+        image_paths: List[Path],
+        transform: albu.Compose,
+        shapes: List[Tuple[int, int]],
+        buckets: np.ndarray,
+        generate_mask: bool = True,
+        mask_bank: Optional[MaskBank] = None,
+    ) -> None:
+        super().__init__(image_paths, transform, None, generate_mask, mask_bank)
+        self.shapes = shapes  # (height, width) of the buckets
+        self.buckets = buckets  # bucket of every image
+        self.transforms = [albu.Compose([albu.RandomCrop(height, width), transform]) for height, width in shapes]
+
+    def load_image(self, index: int) -> np.ndarray:
+        image = super().load_image(index)
+        height, width = self.shapes[self.buckets[index]]
+
+        scale = max(height / image.shape[0], width / image.shape[1])
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        size = (max(width, round(image.shape[1] * scale)), max(height, round(image.shape[0] * scale)))
+        return cv2.resize(image, size, interpolation=interpolation)
+
+    def get_transform(self, index: int) -> albu.Compose:
+        return self.transforms[self.buckets[index]]
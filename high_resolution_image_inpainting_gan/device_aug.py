@@ -0,0 +1,106 @@
+"""Augmentations of the batch on the training device, for uint8 images from the dataloader workers.
+
+With `device_aug: True` in `train_parameters` the tail of `train_aug` made of HorizontalFlip, ColorJitter without hue
+and Normalize is run on the device by DeviceAugmentation, the workers only decode, resize and crop, and return uint8
+images, 4 times fewer bytes to copy to the device than float32.
+"""
+
+import copy
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+
+DEVICE_TRANSFORMS = {"HorizontalFlip", "ColorJitter", "Normalize"}
+
+
+def get_name(transform: Dict[str, Any]) -> str:
+    return transform["__class_fullname__"].split(".")[-1]
+
+
+def get_range(value: Union[float, Sequence[float]]) -> Tuple[float, float]:
+    """Range of a ColorJitter factor, a number x is the range [max(0, 1 - x), 1 + x] as in albumentations."""
+    if isinstance(value, (int, float)):
+        return max(0.0, 1 - value), 1 + value
+    return float(value[0]), float(value[1])
+
+
+def get_p(transform: Dict[str, Any]) -> float:
+    return 1 if transform.get("always_apply", False) else transform.get("p", 0.5)
+
+
+def is_device_transform(transform: Dict[str, Any]) -> bool:
+    name = get_name(transform)
+    if name == "ColorJitter":  # hue jitter stays in the workers
+        hue = transform.get("hue", 0)
+        return all(x == 0 for x in (hue if isinstance(hue, (list, tuple)) else [hue]))
+    return name in DEVICE_TRANSFORMS
+
+
+def grayscale(x: torch.Tensor) -> torch.Tensor:
+    """[B, 3, H, W] RGB -> [B, 1, H, W]."""
+    return 0.299 * x[:, 0:1] + 0.587 * x[:, 1:2] + 0.114 * x[:, 2:3]
+
+
+def split_transform(transform: Dict[str, Any]) -> Tuple[Dict[str, Any], "DeviceAugmentation"]:
+    """Serialized albumentations Compose without the device transforms at the end, and these transforms."""
+    result = copy.deepcopy(transform)
+    transforms = result["transform"]["transforms"]
+
+    device_transforms: List[Dict[str, Any]] = []
+    while transforms and is_device_transform(transforms[-1]):
+        device_transforms.insert(0, transforms.pop())
+
+    if not device_transforms or get_name(device_transforms[-1]) != "Normalize":
+        raise ValueError("device_aug requires Normalize at the end of train_aug.")
+
+    return result, DeviceAugmentation(device_transforms)
+
+
+class DeviceAugmentation:
+    """
+    Input: uint8 images [B, 3, H, W] on any device
+    Output: float images after the transforms, in the order of `train_aug`
+
+    `transforms` are serialized albumentations HorizontalFlip, ColorJitter (brightness, contrast, saturation) and
+    Normalize. Every image gets its own random flip and jitter factors, the jitter is applied in the fixed order
+    brightness, contrast, saturation.
+    """
+
+    def __init__(self, transforms: List[Dict[str, Any]]) -> None:
+        self.transforms = transforms
+
+    def __call__(self, images: torch.Tensor, generator: Optional[torch.Generator] = None) -> torch.Tensor:
+        batch_size = images.shape[0]
+        x = images.float() / 255
+
+        def rand(low: float = 0, high: float = 1) -> torch.Tensor:  # [B, 1, 1, 1]
+            values = torch.rand(batch_size, 1, 1, 1, generator=generator, device=images.device)
+            return low + (high - low) * values
+
+        for transform in self.transforms:
+            name = get_name(transform)
+
+            if name == "HorizontalFlip":
+                x = torch.where(rand() < get_p(transform), x.flip(3), x)
+
+            elif name == "ColorJitter":
+                applied = rand() < get_p(transform)
+
+                def factor(key: str) -> torch.Tensor:
+                    value = rand(*get_range(transform.get(key, 0)))
+                    return torch.where(applied, value, torch.ones_like(value))
+
+                brightness, contrast, saturation = factor("brightness"), factor("contrast"), factor("saturation")
+
+                x = (x * brightness).clamp(0, 1)
+                average = grayscale(x).mean(dim=(2, 3), keepdim=True)
+                x = ((x - average) * contrast + average).clamp(0, 1)
+                gray = grayscale(x)
+                x = ((x - gray) * saturation + gray).clamp(0, 1)
+
+            else:  # Normalize, defaults of albumentations
+                mean = x.new_tensor(transform.get("mean", (0.485, 0.456, 0.406))).reshape(1, -1, 1, 1)
+                std = x.new_tensor(transform.get("std", (0.229, 0.224, 0.225))).reshape(1, -1, 1, 1)
+                x = (x * 255 / transform.get("max_pixel_value", 255) - mean) / std
+
+        return x
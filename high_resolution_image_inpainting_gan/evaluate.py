@@ -0,0 +1,105 @@
+import argparse
+import json
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import torch
+import yaml
+from addict import Dict as Adict
+from albumentations.core.serialization import from_dict
+from iglovikov_helper_functions.config_parsing.utils import object_from_dict
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from high_resolution_image_inpainting_gan.dataset import (
+    IMAGE_EXTENSIONS,
+    InpaintDataset,
+)
+from high_resolution_image_inpainting_gan.inference import Inpainter, load_generator
+from high_resolution_image_inpainting_gan.inpainting_network import (
+    VGG16FeatureExtractor,
+)
+from high_resolution_image_inpainting_gan.masks import StrokeMaskGenerator
+from high_resolution_image_inpainting_gan.metrics import compute_metrics
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-c", "--config_path", type=Path, help="Path to the config.", required=True)
+    arg("-w", "--checkpoint_path", type=Path, help="Path to the checkpoint.", required=True)
+    arg("-i", "--image_path", type=Path, help="Path to the folder with images.", required=True)
+    arg("-o", "--output_path", type=Path, help="Path to save metrics, json file.", required=True)
+    arg("-b", "--batch_size", type=int, help="Batch size.", default=8)
+    arg("-j", "--num_workers", type=int, help="Number of dataloader workers.", default=8)
+    arg("--no_vgg", action="store_true", help="Skip the VGG distance.")
+    arg("--fuse", action="store_true", help="Use fused gated convolutions.")
+    arg("--device", type=str, help="Device to run on.", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+def main():
+    """Metrics of the generator on images transformed by `val_aug` of the config, with the validation masks.
+
+    Masks are the evaluation subset of the mask bank if the config has one, otherwise stroke masks generated with
+    the same seeds as in the validation of train.py.
+    """
+    args = get_args()
+
+    with open(args.config_path) as f:
+        config = Adict(yaml.load(f, Loader=yaml.SafeLoader))
+
+    model = Inpainter(load_generator(config, args.checkpoint_path, args.fuse)).to(args.device)
+    extractor = None if args.no_vgg else VGG16FeatureExtractor().to(args.device).eval()
+
+    mask_bank = object_from_dict(config["mask_bank"]) if "mask_bank" in config else None
+    use_mask_bank = mask_bank is not None and mask_bank.num_eval > 0
+
+    image_paths = sorted(x for x in args.image_path.rglob("*") if x.suffix.lower() in IMAGE_EXTENSIONS)
+    dataset = InpaintDataset(
+        image_paths, from_dict(config.val_aug), generate_mask=use_mask_bank, mask_bank=mask_bank, evaluation=True
+    )
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=True)
+
+    values: Dict[str, List[float]] = defaultdict(list)
+    start = time.perf_counter()
+
+    with torch.no_grad():
+        for batch_idx, batch in enumerate(tqdm(dataloader)):
+            images = batch["image"].to(args.device, non_blocking=True)
+
+            if "mask" in batch:
+                masks = batch["mask"].to(args.device, non_blocking=True)
+            else:
+                generator = torch.Generator(device=images.device)
+                generator.manual_seed(hash((config.seed, batch_idx)))
+                masks = StrokeMaskGenerator()(
+                    images.shape[0], images.shape[2], images.shape[3], args.device, generator
+                )
+
+            result = model(images, masks)
+
+            for name, value in compute_metrics(result, images, masks, extractor).items():
+                values[name] += value.cpu().tolist()
+
+    images_per_second = len(dataset) / (time.perf_counter() - start)
+
+    summary = {name: float(np.mean(value)) for name, value in values.items()}
+    print(json.dumps(summary, indent=2))
+    print(f"{images_per_second:.1f} images / sec")
+
+    per_image = [
+        {"image": str(path.relative_to(args.image_path)), **{name: value[i] for name, value in values.items()}}
+        for i, path in enumerate(image_paths)
+    ]
+
+    args.output_path.parent.mkdir(exist_ok=True, parents=True)
+    with open(args.output_path, "w") as f:
+        json.dump({"metrics": summary, "images_per_second": images_per_second, "images": per_image}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
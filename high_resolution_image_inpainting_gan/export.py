@@ -0,0 +1,148 @@
+import argparse
+from pathlib import Path
+from typing import List, Tuple
+
+import torch
+import yaml
+from addict import Dict as Adict
+from torch import nn
+
+from high_resolution_image_inpainting_gan.inference import Inpainter, load_generator
+from high_resolution_image_inpainting_gan.masks import StrokeMaskGenerator
+from high_resolution_image_inpainting_gan.network_module import fuse_gated_conv2d
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-c", "--config_path", type=Path, help="Path to the config.", required=True)
+    arg("-w", "--checkpoint_path", type=Path, help="Path to the Lightning checkpoint.", required=True)
+    arg("-o", "--output_path", type=Path, help="Folder to save exported models.", required=True)
+    arg("--height", type=int, help="Height of the exported input, multiple of 16.", default=512)
+    arg("--width", type=int, help="Width of the exported input, multiple of 16.", default=512)
+    arg("-b", "--batch_size", type=int, help="Batch size of the example input.", default=1)
+    arg(
+        "--outputs",
+        choices=["refined", "both"],
+        help="refined - composited refinement output only, both - coarse and refinement outputs.",
+        default="refined",
+    )
+    arg("--formats", nargs="+", choices=["torchscript", "onnx"], help="Export formats.", default=["torchscript"])
+    arg("--opset", type=int, help="ONNX opset version.", default=13)
+    arg("--fuse", action="store_true", help="Use fused gated convolutions.")
+    arg("--tolerance", type=float, help="Max absolute difference with the eager model.", default=1e-4)
+    return parser.parse_args()
+
+
+def check_parity(name: str, expected: List[torch.Tensor], actual: List[torch.Tensor], tolerance: float) -> None:
+    difference = max(float((x - torch.as_tensor(y)).abs().max()) for x, y in zip(expected, actual))
+    print(f"{name}: max absolute difference {difference:.2e}")
+
+    if difference > tolerance:
+        raise ValueError(f"{name} output differs from the eager model by {difference}, tolerance {tolerance}")
+
+
+def get_example(batch_size: int, height: int, width: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    generator = torch.Generator()
+    generator.manual_seed(0)
+
+    image = torch.rand(batch_size, 3, height, width, generator=generator)
+    mask = StrokeMaskGenerator()(batch_size, height, width, generator=generator)
+    return image, mask
+
+
+def export_torchscript(model: nn.Module, example: Tuple[torch.Tensor, torch.Tensor], path: Path, tolerance: float):
+    traced = torch.jit.freeze(torch.jit.trace(model, example))
+    traced.save(str(path))
+
+    # the saved file is checked, not the traced module in memory
+    loaded = torch.jit.load(str(path))
+    with torch.no_grad():
+        check_parity("torchscript", as_list(model(*example)), as_list(loaded(*example)), tolerance)
+
+
+def export_onnx(
+    model: nn.Module,
+    example: Tuple[torch.Tensor, torch.Tensor],
+    path: Path,
+    output_names: List[str],
+    opset: int,
+    tolerance: float,
+) -> None:
+    torch.onnx.export(
+        model,
+        example,
+        str(path),
+        input_names=["image", "mask"],
+        output_names=output_names,
+        dynamic_axes={x: {0: "batch_size"} for x in ["image", "mask"] + output_names},
+        opset_version=opset,
+        dynamo=False,
+    )
+
+    try:
+        import onnxruntime  # pylint: disable=C0415
+    except ImportError:
+        print("onnxruntime is not installed, ONNX parity is not checked.")
+        return
+
+    session = onnxruntime.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+    actual = session.run(None, {"image": example[0].numpy(), "mask": example[1].numpy()})
+
+    with torch.no_grad():
+        check_parity("onnx", as_list(model(*example)), actual, tolerance)
+
+
+def as_list(outputs) -> List[torch.Tensor]:
+    if isinstance(outputs, torch.Tensor):
+        return [outputs]
+    return list(outputs)
+
+
+def main():
+    """Export the generator of a Lightning checkpoint for inference.
+
+    The checkpoint also has the discriminator, VGG16 of the perceptual loss and the optimizer states, only the
+    generator weights are saved to generator.pth, which `load_generator` reads. Traced models have the padding
+    for the exported height and width built in and accept other batch sizes.
+    """
+    args = get_args()
+
+    with open(args.config_path) as f:
+        config = Adict(yaml.load(f, Loader=yaml.SafeLoader))
+
+    generator = load_generator(config, args.checkpoint_path)
+
+    # tracing needs the dense path of the generator
+    generator.sparse_tile_size = None
+    generator.attention.memory_budget = None
+
+    args.output_path.mkdir(exist_ok=True, parents=True)
+    torch.save(generator.state_dict(), args.output_path / "generator.pth")
+
+    if args.fuse:  # after saving, fused weights can not be loaded by load_generator
+        fuse_gated_conv2d(generator)
+
+    if args.outputs == "refined":
+        model = Inpainter(generator).eval()
+        output_names = ["result"]
+    else:
+        model = generator
+        output_names = ["first_out", "second_out"]
+
+    example = get_example(args.batch_size, args.height, args.width)
+
+    if "torchscript" in args.formats:
+        export_torchscript(model, example, args.output_path / "generator.pt", args.tolerance)
+
+    if "onnx" in args.formats:
+        export_onnx(model, example, args.output_path / "generator.onnx", output_names, args.opset, args.tolerance)
+
+    for path in sorted(args.output_path.iterdir()):
+        print(f"{path}: {path.stat().st_size / 2 ** 20:.1f} MB")
+
+    print(f"{args.checkpoint_path}: {args.checkpoint_path.stat().st_size / 2 ** 20:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
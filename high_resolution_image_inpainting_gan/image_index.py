@@ -0,0 +1,167 @@
+import argparse
+import hashlib
+import io
+import os
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from high_resolution_image_inpainting_gan.dataset import IMAGE_EXTENSIONS
+
+FIELDS = ["paths", "sizes", "mtimes", "heights", "widths", "hashes"]
+
+EXIF_ORIENTATION = 0x0112  # 5 - 8 are rotations by 90 degrees, cv2.imread applies them
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-i", "--image_path", type=Path, help="Path to the folder with images.", required=True)
+    arg("-o", "--output_path", type=Path, help="Path to the index, npz file, updated if exists.", required=True)
+    arg("-j", "--num_workers", type=int, help="Number of workers.", default=16)
+    return parser.parse_args()
+
+
+class ImageIndex:
+    """Paths relative to the image folder, byte sizes, modification times, dimensions and content hashes of images.
+
+    Stored as arrays in a npz file, so it is loaded in milliseconds instead of listing the image folder.
+    """
+
+    def __init__(
+        self,
+        paths: np.ndarray,
+        sizes: np.ndarray,
+        mtimes: np.ndarray,
+        heights: np.ndarray,
+        widths: np.ndarray,
+        hashes: np.ndarray,
+    ) -> None:
+        self.paths = paths  # utf-8 bytes
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.heights = heights  # after the exif rotation, as loaded by cv2
+        self.widths = widths
+        self.hashes = hashes  # first 8 bytes of blake2b of the file
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    @classmethod
+    def load(cls, path: Union[Path, str]) -> "ImageIndex":
+        with np.load(path) as data:
+            return cls(**{x: data[x] for x in FIELDS})
+
+    def save(self, path: Path) -> None:
+        with open(path, "wb") as f:  # np.savez appends .npz to paths without it
+            np.savez(f, **{x: getattr(self, x) for x in FIELDS})
+
+    def image_paths(self, image_path: Path) -> List[Path]:
+        return [image_path / x.decode() for x in self.paths]
+
+    @property
+    def aspect_ratios(self) -> np.ndarray:
+        return self.widths / self.heights
+
+
+def list_images(image_path: Path, folder: Path) -> List[Tuple[str, int, float]]:
+    """Relative path, byte size and modification time of the images in the folder and its subfolders."""
+    result = []
+    for root, _, file_names in os.walk(folder):
+        for file_name in file_names:
+            if Path(file_name).suffix.lower() in IMAGE_EXTENSIONS:
+                path = Path(root) / file_name
+                stat = path.stat()
+                result.append((str(path.relative_to(image_path)), stat.st_size, stat.st_mtime))
+    return result
+
+
+def list_images_star(args: Tuple[Path, Path]) -> List[Tuple[str, int, float]]:
+    return list_images(*args)
+
+
+def read_metadata(image_path: Path) -> Optional[Tuple[int, int, int]]:
+    """Height, width and hash of the image, dimensions are parsed from the header. None if it is not an image."""
+    with open(image_path, "rb") as f:
+        data = f.read()
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        if image.getexif().get(EXIF_ORIENTATION, 1) in {5, 6, 7, 8}:
+            height, width = width, height
+    except (OSError, SyntaxError, ValueError):  # PIL.UnidentifiedImageError is OSError
+        return None
+
+    return height, width, int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def build_index(image_path: Path, previous: Optional[ImageIndex] = None, num_workers: int = 16) -> ImageIndex:
+    """Index of the images in the folder, entries of `previous` with the same size and time are not read again."""
+    with Pool(num_workers) as pool:
+        # the folders of the top level are listed in parallel
+        folders = [x for x in image_path.iterdir() if x.is_dir()]
+        files = [x for x in image_path.iterdir() if x.is_file() and x.suffix.lower() in IMAGE_EXTENSIONS]
+
+        listed = [(str(x.relative_to(image_path)), x.stat().st_size, x.stat().st_mtime) for x in files]
+        for result in tqdm(
+            pool.imap_unordered(list_images_star, ((image_path, x) for x in folders)), total=len(folders)
+        ):
+            listed += result
+
+        listed.sort()
+
+        known: Dict[str, int] = {}
+        if previous is not None:
+            known = {x.decode(): i for i, x in enumerate(previous.paths)}
+
+        rows: List[Optional[Tuple[int, int, int]]] = [None] * len(listed)
+        new = []
+
+        for i, (path, size, mtime) in enumerate(listed):
+            j = known.get(path)
+            if previous is not None and j is not None and previous.sizes[j] == size and previous.mtimes[j] == mtime:
+                rows[i] = previous.heights[j], previous.widths[j], previous.hashes[j]
+            else:
+                new.append(i)
+
+        print(f"{len(listed)} images, {len(new)} new or modified")
+
+        metadata = pool.imap(read_metadata, (image_path / listed[i][0] for i in new), chunksize=16)
+        for i, row in zip(new, tqdm(metadata, total=len(new))):
+            rows[i] = row
+
+    valid = [i for i, row in enumerate(rows) if row is not None]
+    if len(valid) < len(listed):
+        print(f"{len(listed) - len(valid)} files are not images and are not indexed")
+
+    return ImageIndex(
+        paths=np.array([listed[i][0].encode() for i in valid], dtype=bytes),
+        sizes=np.array([listed[i][1] for i in valid], dtype=np.int64),
+        mtimes=np.array([listed[i][2] for i in valid], dtype=np.float64),
+        heights=np.array([rows[i][0] for i in valid], dtype=np.int32),  # type: ignore
+        widths=np.array([rows[i][1] for i in valid], dtype=np.int32),  # type: ignore
+        hashes=np.array([rows[i][2] for i in valid], dtype=np.uint64),  # type: ignore
+    )
+
+
+def main():
+    """Index of the training images for `image_index` in `train_parameters` of the config.
+
+    If the index exists, only new and modified files are read, removed files are dropped.
+    """
+    args = get_args()
+
+    previous = ImageIndex.load(args.output_path) if args.output_path.exists() else None
+    index = build_index(args.image_path, previous, args.num_workers)
+
+    args.output_path.parent.mkdir(exist_ok=True, parents=True)
+    index.save(args.output_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import csv
+import json
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import torch
+import yaml
+from addict import Dict as Adict
+from iglovikov_helper_functions.utils.image_utils import load_rgb
+from torch import nn
+from tqdm import tqdm
+
+from high_resolution_image_inpainting_gan.cra import ContextualResidualAggregation
+from high_resolution_image_inpainting_gan.dataset import IMAGE_EXTENSIONS
+from high_resolution_image_inpainting_gan.inference import (
+    Inpainter,
+    collate_bucket,
+    get_bucket,
+    load_generator,
+)
+from high_resolution_image_inpainting_gan.tiling import TiledInpainter
+
+Sample = Tuple[Path, Path, Path]  # image path, mask path, output path
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-c", "--config_path", type=Path, help="Path to the config.", required=True)
+    arg("-w", "--checkpoint_path", type=Path, help="Path to the checkpoint.", required=True)
+    arg(
+        "-i",
+        "--input_path",
+        type=Path,
+        help="Folder with images or csv / jsonl manifest with `image`, `mask` and optional `output` columns.",
+        required=True,
+    )
+    arg("-m", "--mask_path", type=Path, help="Folder with png masks, required if input_path is a folder.")
+    arg("-o", "--output_path", type=Path, help="Path to save results.", required=True)
+    arg("-b", "--batch_size", type=int, help="Batch size.", default=8)
+    arg("-j", "--num_workers", type=int, help="Number of decode workers.", default=8)
+    arg("--num_encode_workers", type=int, help="Number of encode workers.", default=4)
+    arg("--max_buffered", type=int, help="Max number of decoded images waiting for a full batch.", default=64)
+    arg(
+        "--mode",
+        choices=["direct", "cra", "tiled"],
+        help="cra - contextual residual aggregation, tiled - generator on overlapping tiles with holes.",
+        default="direct",
+    )
+    arg("--low_resolution", type=int, help="Resolution of the generator pass in the cra mode.", default=512)
+    arg("--tile_size", type=int, help="Tile size in the tiled mode.", default=512)
+    arg("--tile_overlap", type=int, help="Overlap of neighbouring tiles in the tiled mode.", default=128)
+    arg("--tiles_per_batch", type=int, help="Number of tiles in a generator batch in the tiled mode.", default=8)
+    arg("--sparse_tile_size", type=int, help="Decode only tiles of this size with holes, multiple of 16.")
+    arg("--attention_memory_budget", type=int, help="Compute the attention in chunks of this size, MB.")
+    arg("--fuse", action="store_true", help="Use fused gated convolutions.")
+    arg("--device", type=str, help="Device to run on.", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+def manifest_sample(row: Dict[str, str], root: Path, output_path: Path) -> Sample:
+    output_name = row.get("output") or Path(row["image"]).with_suffix(".png").name
+    return root / row["image"], root / row["mask"], output_path / output_name
+
+
+def iterate_samples(input_path: Path, mask_path: Optional[Path], output_path: Path) -> Iterator[Sample]:
+    """Lazily list samples, so millions of images start processing without a full listing."""
+    if input_path.is_dir():
+        if mask_path is None:
+            raise ValueError("mask_path is required if input_path is a folder.")
+
+        for image_file_path in input_path.rglob("*"):
+            if image_file_path.suffix.lower() not in IMAGE_EXTENSIONS:
+                continue
+            relative_path = image_file_path.relative_to(input_path).with_suffix(".png")
+            yield image_file_path, mask_path / relative_path, output_path / relative_path
+
+    elif input_path.suffix == ".csv":
+        with open(input_path) as f:
+            for row in csv.DictReader(f):
+                yield manifest_sample(row, input_path.parent, output_path)
+
+    elif input_path.suffix == ".jsonl":
+        with open(input_path) as f:
+            for line in f:
+                if line.strip():
+                    yield manifest_sample(json.loads(line), input_path.parent, output_path)
+    else:
+        raise ValueError(f"input_path should be a folder, csv or jsonl file, got {input_path}")
+
+
+def decode(sample: Sample) -> Dict[str, Any]:
+    image_path, mask_path, output_path = sample
+
+    image = load_rgb(image_path)
+    mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+
+    if mask is None:
+        raise FileNotFoundError(f"Mask not found {mask_path}")
+
+    if mask.shape != image.shape[:2]:
+        raise ValueError(f"Image {image_path} and mask {mask_path} have different sizes.")
+
+    return {
+        "image": torch.from_numpy(np.ascontiguousarray(np.transpose(image, (2, 0, 1)))),
+        "mask": torch.from_numpy(mask > 127)[None],
+        "output_path": output_path,
+    }
+
+
+def encode(image: np.ndarray, output_path: Path) -> None:
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    cv2.imwrite(str(output_path), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+
+
+def prefetch(
+    pool: ThreadPoolExecutor, function: Callable, iterable: Iterable, depth: int
+) -> Iterator[Tuple[Any, Future]]:
+    """Ordered map over the pool, that keeps at most `depth` tasks in flight."""
+    futures: Deque[Tuple[Any, Future]] = deque()
+
+    for item in iterable:
+        futures.append((item, pool.submit(function, item)))
+        if len(futures) >= depth:
+            yield futures.popleft()
+
+    while futures:
+        yield futures.popleft()
+
+
+def run_batch(
+    model: nn.Module,
+    samples: List[Dict[str, Any]],
+    bucket: Tuple[int, int],
+    device: str,
+    encode_pool: ThreadPoolExecutor,
+    writes: Deque[Future],
+) -> None:
+    images = [sample["image"].to(device, non_blocking=True).float() / 255 for sample in samples]
+    masks = [sample["mask"].to(device, non_blocking=True).float() for sample in samples]
+    images, masks = collate_bucket(images, masks, bucket)
+
+    with torch.no_grad():
+        result = model(images, masks)
+
+    result = (result * 255).round().clamp(0, 255).byte().permute(0, 2, 3, 1).cpu().numpy()
+
+    for sample, image in zip(samples, result):
+        height, width = sample["image"].shape[1:]
+        writes.append(encode_pool.submit(encode, image[:height, :width], sample["output_path"]))
+
+
+def main():
+    args = get_args()
+
+    with open(args.config_path) as f:
+        config = Adict(yaml.load(f, Loader=yaml.SafeLoader))
+
+    generator = load_generator(config, args.checkpoint_path, args.fuse).to(args.device)
+
+    if args.sparse_tile_size is not None:
+        generator.sparse_tile_size = args.sparse_tile_size
+
+    if args.attention_memory_budget is not None:
+        generator.attention.memory_budget = args.attention_memory_budget
+
+    input_device = args.device
+
+    if args.mode == "cra":
+        model = ContextualResidualAggregation(generator, args.low_resolution)
+        bucket_multiple = 1  # the low resolution size depends on the exact image size
+    elif args.mode == "tiled":
+        model = TiledInpainter(generator, args.tile_size, args.tile_overlap, args.tiles_per_batch)
+        bucket_multiple = 1
+        input_device = "cpu"  # only tiles are moved to the device
+    else:
+        model = Inpainter(generator)
+        bucket_multiple = generator.patch_size
+
+    samples = iterate_samples(args.input_path, args.mask_path, args.output_path)
+
+    buckets: Dict[Tuple[int, int], List[Dict[str, Any]]] = defaultdict(list)
+    num_buffered = 0
+    writes: Deque[Future] = deque()
+
+    with ThreadPoolExecutor(args.num_workers) as decode_pool, ThreadPoolExecutor(
+        args.num_encode_workers
+    ) as encode_pool:
+        for (image_path, _, _), future in tqdm(
+            prefetch(decode_pool, decode, samples, args.num_workers * args.batch_size)
+        ):
+            try:
+                sample = future.result()
+            except (OSError, ValueError, cv2.error) as e:
+                print(f"Skip {image_path}: {e}")
+                continue
+
+            bucket = get_bucket(*sample["image"].shape[1:], bucket_multiple)
+            buckets[bucket].append(sample)
+            num_buffered += 1
+
+            if len(buckets[bucket]) < args.batch_size and num_buffered < args.max_buffered:
+                continue
+
+            if len(buckets[bucket]) < args.batch_size:  # too many images wait, run the fullest bucket
+                bucket = max(buckets, key=lambda x: len(buckets[x]))
+
+            batch = buckets.pop(bucket)
+            num_buffered -= len(batch)
+            run_batch(model, batch, bucket, input_device, encode_pool, writes)
+
+            while len(writes) > args.max_buffered:
+                writes.popleft().result()
+
+        for bucket, batch in buckets.items():
+            run_batch(model, batch, bucket, input_device, encode_pool, writes)
+
+        while writes:
+            writes.popleft().result()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+from pathlib import Path
+from typing import Any, Dict, List, Tuple, Union
+
+import torch
+from iglovikov_helper_functions.config_parsing.utils import object_from_dict
+from torch import nn
+from torch.nn import functional as F
+
+from high_resolution_image_inpainting_gan.network_module import fuse_gated_conv2d
+
+
+def load_generator(config: Dict[str, Any], checkpoint_path: Union[Path, str], fuse: bool = False) -> nn.Module:
+    """Create the generator from the config and load weights from a Lightning checkpoint or a plain state dict.
+
+    With `fuse` gated convolutions are converted to FusedGatedConv2d after loading.
+    """
+    generator = object_from_dict(config["generator"])
+
+    state_dict = torch.load(checkpoint_path, map_location="cpu")
+    if "state_dict" in state_dict:  # Lightning checkpoint
+        state_dict = {
+            key[len("generator.") :]: value
+            for key, value in state_dict["state_dict"].items()
+            if key.startswith("generator.")
+        }
+
+    generator.load_state_dict(state_dict)
+
+    if fuse:
+        fuse_gated_conv2d(generator)
+
+    return generator.eval()
+
+
+class Inpainter(nn.Module):
+    """
+    Input: image in range [0, 1] + mask (1 - hole, 0 - non hole)
+    Output: image with holes filled by the refinement network
+    """
+
+    def __init__(self, generator: nn.Module) -> None:
+        super().__init__()
+        self.generator = generator
+
+    def forward(self, image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        _, second_out = self.generator(image, mask)
+        return image * (1 - mask) + second_out * mask
+
+
+def get_bucket(height: int, width: int, multiple: int) -> Tuple[int, int]:
+    return height + (-height) % multiple, width + (-width) % multiple
+
+
+def collate_bucket(
+    images: List[torch.Tensor], masks: List[torch.Tensor], bucket: Tuple[int, int]
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Pad [3, H, W] images and [1, H, W] masks to the bucket size the same way GatedGenerator pads its input."""
+    padded_images = []
+    padded_masks = []
+
+    for image, mask in zip(images, masks):
+        pad = (0, bucket[1] - image.shape[2], 0, bucket[0] - image.shape[1])
+        padded_images.append(F.pad(image[None], pad, mode="replicate"))
+        padded_masks.append(F.pad(mask[None], pad, value=0))
+
+    return torch.cat(padded_images), torch.cat(padded_masks)
@@ -1,21 +1,31 @@
-from typing import Tuple
+from typing import List, Optional, Sequence, Tuple
 
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from torchvision import models
 
 from high_resolution_image_inpainting_gan.network_module import Conv2dLayer, GatedConv2d
 
 
+def run_segment(block: nn.Module, x: torch.Tensor, checkpoint_segments: bool) -> torch.Tensor:
+    """Run the block, with `checkpoint_segments` in training only its input is kept for backward and the
+    activations inside the block are recomputed."""
+    if checkpoint_segments and block.training and torch.is_grad_enabled():
+        return checkpoint(block, x, use_reentrant=False)
+    return block(x)
+
+
 class Coarse(nn.Module):
     """
     Input: masked image + mask
     Output: filled image
     """
 
-    def __init__(self, norm: str, activation: str) -> None:
+    def __init__(self, norm: str, activation: str, checkpoint_segments: bool = False) -> None:
         super().__init__()
+        self.checkpoint_segments = checkpoint_segments
         # Initialize the padding scheme
         self.coarse1 = nn.Sequential(
             # encoder
@@ -68,23 +78,165 @@ class Coarse(nn.Module):
         )
 
     def forward(self, first_in: torch.Tensor) -> torch.Tensor:
-        first_out = self.coarse1(first_in)
-        first_out = self.coarse2(first_out) + first_out
-        first_out = self.coarse3(first_out) + first_out
-        first_out = self.coarse4(first_out) + first_out
-        first_out = self.coarse5(first_out) + first_out
-        first_out = self.coarse6(first_out) + first_out
-        first_out = self.coarse7(first_out) + first_out
-        first_out = self.coarse8(first_out) + first_out
-        return self.coarse9(first_out)
+        first_out = self.segment(self.coarse1, first_in)
+        first_out = self.segment(self.coarse2, first_out) + first_out
+        first_out = self.segment(self.coarse3, first_out) + first_out
+        first_out = self.segment(self.coarse4, first_out) + first_out
+        first_out = self.segment(self.coarse5, first_out) + first_out
+        first_out = self.segment(self.coarse6, first_out) + first_out
+        first_out = self.segment(self.coarse7, first_out) + first_out
+        first_out = self.segment(self.coarse8, first_out) + first_out
+        return self.segment(self.coarse9, first_out)
+
+    def segment(self, block: nn.Module, x: torch.Tensor) -> torch.Tensor:
+        return run_segment(block, x, self.checkpoint_segments)
+
+
+class ContextualAttention(nn.Module):
+    """
+    Input: features [B, C, H / 8, W / 8] for the attention scores, hole patches [B, 1, H / 16, W / 16] and
+        values [B, C', H', W'] with H' and W' divisible by the patch grid
+    Output: values in the hole patches replaced by the attention weighted sum of the context patches, zero outside
+
+    With `memory_budget` (MB) the scores are computed in chunks of hole patches against the context patches only,
+    so the dense [B, N, N] attention matrix is never created.
+
+    `chunked_attention_transfer` can compute only the rows of some hole patches, `queries` [B, 1, H / 16, W / 16],
+    it is used to update the transferred values after a local change of the mask.
+    """
+
+    def __init__(self, memory_budget: Optional[int] = None) -> None:
+        super().__init__()
+        self.memory_budget = memory_budget
+
+    def forward(self, feature: torch.Tensor, patch_fb: torch.Tensor, values: List[torch.Tensor]) -> List[torch.Tensor]:
+        grid = patch_fb.shape[2:]
+
+        if self.memory_budget is None:
+            att = self.compute_attention(feature, patch_fb)
+            return [self.attention_transfer(value, att, grid) for value in values]
+
+        return self.chunked_attention_transfer(feature, patch_fb, values)
+
+    def chunked_attention_transfer(
+        self,
+        feature: torch.Tensor,
+        patch_fb: torch.Tensor,
+        values: List[torch.Tensor],
+        queries: Optional[torch.Tensor] = None,
+    ) -> List[torch.Tensor]:
+        """Transferred values of the hole patches, or of the hole patches in `queries` only, zero elsewhere."""
+        batch_size, num_channels = feature.shape[:2]
+        grid_height, grid_width = patch_fb.shape[2:]
+
+        feature = F.interpolate(feature, size=patch_fb.shape[2:], mode="bilinear")  # in: [B, C:128, H / 16, W / 16]
+        f = feature.permute([0, 2, 3, 1]).reshape([batch_size, grid_height * grid_width, num_channels])
+        f = f / torch.sqrt((f * f).sum(axis=2, keepdim=True))  # cosine similarity is a dot product of unit vectors
+        p_fb = torch.reshape(patch_fb, [batch_size, grid_height * grid_width])
+        q_fb = p_fb if queries is None else p_fb * torch.reshape(queries, [batch_size, grid_height * grid_width])
+
+        # [B, C', grid_height, patch_height, grid_width, patch_width] views, patches are indexed by (row, col)
+        patches = [
+            value.reshape([batch_size, value.shape[1], grid_height, value.shape[2] // grid_height, grid_width, -1])
+            for value in values
+        ]
+        outputs = [torch.zeros_like(patch) for patch in patches]
+
+        for b in range(batch_size):
+            hole = torch.nonzero(p_fb[b] > 0, as_tuple=True)[0]
+            context = torch.nonzero(p_fb[b] == 0, as_tuple=True)[0]
+            rows = torch.nonzero(q_fb[b] > 0, as_tuple=True)[0]
+
+            if not len(rows) or not len(context):
+                continue
+
+            context_rows, context_cols = context // grid_width, context % grid_width
+            keys = f[b, context]  # [N_context, C]
+            context_values = [
+                patch[b, :, context_rows, :, context_cols].reshape([len(context), -1]) for patch in patches
+            ]
+
+            # scores + weights and the transferred values for every hole patch in the chunk, float32
+            row_bytes = 4 * (2 * len(context) + sum(value.shape[1] for value in context_values))
+            chunk_size = len(rows) if self.memory_budget is None else max(1, self.memory_budget * 2**20 // row_bytes)
+
+            for query in torch.split(rows, chunk_size):
+                weights = torch.exp(torch.mm(f[b, query], keys.t()))  # cosine <= 1, no overflow
+                # hole columns of the dense attention have zero scores, they are in the softmax denominator
+                weights = weights / (weights.sum(dim=1, keepdim=True) + len(hole))
+
+                query_rows, query_cols = query // grid_width, query % grid_width
+                for output, patch, context_value in zip(outputs, patches, context_values):
+                    output[b, :, query_rows, :, query_cols] = torch.mm(weights, context_value).reshape(
+                        [len(query), patch.shape[1], patch.shape[3], patch.shape[5]]
+                    )
+
+        return [output.reshape(value.shape) for output, value in zip(outputs, values)]
+
+    def compute_attention(self, feature, patch_fb):  # in: [B, C:128, H / 8, W / 8]
+        b, num_channels = feature.shape[:2]
+        num_patches = patch_fb.shape[2] * patch_fb.shape[3]
+        feature = F.interpolate(feature, size=patch_fb.shape[2:], mode="bilinear")  # in: [B, C:128, H / 16, W / 16]
+        p_fb = torch.reshape(patch_fb, [b, num_patches, 1])
+        p_matrix = torch.bmm(p_fb, (1 - p_fb).permute([0, 2, 1]))
+        f = feature.permute([0, 2, 3, 1]).reshape([b, num_patches, num_channels])
+        c = self.cosine_matrix(f, f) * p_matrix
+        return F.softmax(c, dim=2) * p_matrix
+
+    def attention_transfer(self, feature, attention, grid):  # feature: [B, C, H, W], grid: patch grid (rows, cols)
+        batch_size, num_channels, height, width = feature.shape
+        f = self.extract_image_patches(feature, grid)
+        f = torch.reshape(f, [batch_size, f.shape[1] * f.shape[2], -1])
+        f = torch.bmm(attention, f)
+        f = torch.reshape(f, [batch_size, grid[0], grid[1], height // grid[0], width // grid[1], num_channels])
+        f = f.permute([0, 5, 1, 3, 2, 4])
+        return torch.reshape(f, [batch_size, num_channels, height, width])
+
+    @staticmethod
+    def extract_image_patches(img, grid):
+        batch_size, num_channels, height, width = img.shape
+        img = torch.reshape(img, [batch_size, num_channels, grid[0], height // grid[0], grid[1], width // grid[1]])
+        img = img.permute([0, 2, 4, 3, 5, 1])
+        return img
+
+    @staticmethod
+    def cosine_matrix(matrix_a, matrix_b):
+        _matrixA_matrixB = torch.bmm(matrix_a, matrix_b.permute([0, 2, 1]))
+        _matrixA_norm = torch.sqrt((matrix_a * matrix_a).sum(axis=2)).unsqueeze(dim=2)
+        _matrixB_norm = torch.sqrt((matrix_b * matrix_b).sum(axis=2)).unsqueeze(dim=2)
+        return _matrixA_matrixB / torch.bmm(_matrixA_norm, _matrixB_norm.permute([0, 2, 1]))
 
 
 class GatedGenerator(nn.Module):
-    def __init__(self, norm: str, activation: str) -> None:
+    """
+    Input: image in range [0, 1] + mask (1 - hole, 0 - non hole), any size
+    Output: coarse and refined images
+
+    Inputs are padded to a multiple of `patch_size`, every attention patch covers `patch_size` x `patch_size`
+    pixels of the input, so the patch grid is [H / 16, W / 16], 32 x 32 for 512 x 512 images.
+
+    With `checkpoint_segments` the activations inside the coarse* and refinement* blocks and the attention transfers
+    are recomputed in the backward pass instead of being kept, training needs less memory and ~30% more time.
+    """
+
+    patch_size = 16
+    decoder_halo = 32  # receptive field of the decoder, in input pixels
+    max_tiles_per_batch = 32
+
+    def __init__(
+        self,
+        norm: str,
+        activation: str,
+        sparse_tile_size: Optional[int] = None,
+        attention_memory_budget: Optional[int] = None,
+        checkpoint_segments: bool = False,
+    ) -> None:
         super().__init__()
+        # in eval mode the decoder runs only on tiles with holes, see `decode_tiles`
+        self.sparse_tile_size = sparse_tile_size
 
         # ######################################### Coarse Network ##################################################
-        self.coarse = Coarse(norm, activation)
+        self.coarse = Coarse(norm, activation, checkpoint_segments)
 
         # ######################################### Refinement Network ##########################################
         self.refinement1 = nn.Sequential(
@@ -135,8 +287,56 @@ class GatedGenerator(nn.Module):
             GatedConv2d(32, 32, 3, 1, 1, 1, "replicate", activation, norm),
             GatedConv2d(32, 32, 3, 1, 2, 2, "replicate", activation, norm),
         )
+        self.attention = ContextualAttention(attention_memory_budget)
+
+    @property
+    def checkpoint_segments(self) -> bool:
+        return self.coarse.checkpoint_segments
+
+    @checkpoint_segments.setter
+    def checkpoint_segments(self, value: bool) -> None:
+        self.coarse.checkpoint_segments = value
+
+    def segment(self, block: nn.Module, x: torch.Tensor) -> torch.Tensor:
+        return run_segment(block, x, self.checkpoint_segments)
 
     def forward(self, image: torch.Tensor, mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        first_out, second_out, _ = self.forward_with_transfer(image, mask)
+        return first_out, second_out
+
+    def forward_with_transfer(
+        self, image: torch.Tensor, mask: torch.Tensor, values: Sequence[torch.Tensor] = ()
+    ) -> Tuple[torch.Tensor, torch.Tensor, List[torch.Tensor]]:
+        """Same as forward, but also transfers `values` [B, C, H', W'] from the context patches to the hole patches
+        with the attention scores of the generator, H' and W' should be divisible by the patch grid."""
+        height, width = image.shape[2:]
+        image, mask = self.pad(image, mask, self.patch_size)
+
+        first_out = self.coarse_forward(image, mask)
+
+        # Refinement
+        second_in = image * (1 - mask) + first_out * mask  # image with hole == 1
+        pl1, pl2, pl3 = self.encode(second_in)
+
+        # Calculate Attention
+        patch_fb = self.cal_patch(mask, self.patch_size)
+
+        if self.checkpoint_segments and self.training and torch.is_grad_enabled() and not values:
+            # the full resolution transfers are recomputed in backward, only the outputs of conv_pl* are kept
+            transferred = checkpoint(self.transfer, pl3, patch_fb, pl2, pl1, use_reentrant=False)
+            second_out = self.decode_transferred(pl3, *transferred)
+            return first_out[:, :, :height, :width], second_out[:, :, :height, :width], []
+
+        transfers = self.attention(pl3, patch_fb, [pl3, pl2, pl1, *values])
+
+        if self.sparse_tile_size is not None and not self.training:
+            second_out = self.decode_tiles(second_in, mask, pl3, transfers[:3], self.sparse_tile_size)
+        else:
+            second_out = self.decode(pl3, *transfers[:3])
+
+        return first_out[:, :, :height, :width], second_out[:, :, :height, :width], transfers[3:]
+
+    def coarse_forward(self, image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
         img_256 = F.interpolate(image, scale_factor=0.5, mode="bilinear")
         mask_256 = F.interpolate(mask, scale_factor=0.5, mode="nearest")  # 1 - hole, 0 - non hole
 
@@ -144,79 +344,130 @@ class GatedGenerator(nn.Module):
 
         first_in = torch.cat((first_masked_img, mask_256), 1)  # in: [B, 4, H, W]x
         first_out = self.coarse(first_in)  # out: [B, 3, H, W]
-        first_out = F.interpolate(first_out, scale_factor=2, mode="bilinear")  # coarse image
-
-        # Refinement
-        second_in = image * (1 - mask) + first_out * mask  # image with hole == 1
-        pl1 = self.refinement1(second_in)  # out: [B, 32, 256, 256]
-        pl2 = self.refinement2(pl1)  # out: [B, 64, 128, 128]
-        second_out = self.refinement3(pl2)  # out: [B, 128, 64, 64]
-        second_out = self.refinement4(second_out) + second_out  # out: [B, 128, 64, 64]
-        second_out = self.refinement5(second_out) + second_out
-        pl3 = self.refinement6(second_out) + second_out  # out: [B, 128, 64, 64]
-        # Calculate Attention
-        patch_fb = self.cal_patch(32, mask, 512)
-        att = self.compute_attention(pl3, patch_fb)
+        return F.interpolate(first_out, scale_factor=2, mode="bilinear")  # coarse image
+
+    def encode(self, second_in: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        pl1 = self.segment(self.refinement1, second_in)  # out: [B, 32, 256, 256]
+        pl2 = self.segment(self.refinement2, pl1)  # out: [B, 64, 128, 128]
+        second_out = self.segment(self.refinement3, pl2)  # out: [B, 128, 64, 64]
+        second_out = self.segment(self.refinement4, second_out) + second_out  # out: [B, 128, 64, 64]
+        second_out = self.segment(self.refinement5, second_out) + second_out
+        pl3 = self.segment(self.refinement6, second_out) + second_out  # out: [B, 128, 64, 64]
+        return pl1, pl2, pl3
+
+    def transfer(
+        self, pl3: torch.Tensor, patch_fb: torch.Tensor, pl2: torch.Tensor, pl1: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Attention transfers of pl3, pl2, pl1 after conv_pl3, conv_pl2, conv_pl1."""
+        transfer_pl3, transfer_pl2, transfer_pl1 = self.attention(pl3, patch_fb, [pl3, pl2, pl1])
+        return self.conv_pl3(transfer_pl3), self.conv_pl2(transfer_pl2), self.conv_pl1(transfer_pl1)
+
+    def decode(
+        self, pl3: torch.Tensor, transfer_pl3: torch.Tensor, transfer_pl2: torch.Tensor, transfer_pl1: torch.Tensor
+    ) -> torch.Tensor:
+        return self.decode_transferred(
+            pl3, self.conv_pl3(transfer_pl3), self.conv_pl2(transfer_pl2), self.conv_pl1(transfer_pl1)
+        )
 
-        second_out = torch.cat((pl3, self.conv_pl3(self.attention_transfer(pl3, att))), 1)  # out: [B, 256, 64, 64]
-        second_out = self.refinement7(second_out)  # out: [B, 64, 128, 128]
+    def decode_transferred(
+        self, pl3: torch.Tensor, feature_pl3: torch.Tensor, feature_pl2: torch.Tensor, feature_pl1: torch.Tensor
+    ) -> torch.Tensor:
+        second_out = torch.cat((pl3, feature_pl3), 1)  # out: [B, 256, 64, 64]
+        second_out = self.segment(self.refinement7, second_out)  # out: [B, 64, 128, 128]
 
         # out: [B, 128, 128, 128]
-        second_out = torch.cat((second_out, self.conv_pl2(self.attention_transfer(pl2, att))), 1)
+        second_out = torch.cat((second_out, feature_pl2), 1)
 
         # out: [B, 32, 256, 256]
-        second_out = self.refinement8(second_out)
+        second_out = self.segment(self.refinement8, second_out)
 
         # out: [B, 64, 256, 256]
-        second_out = torch.cat((second_out, self.conv_pl1(self.attention_transfer(pl1, att))), 1)
+        second_out = torch.cat((second_out, feature_pl1), 1)
 
         # out: [B, 3, H, W]
-        second_out = self.refinement9(second_out)
-        return first_out, second_out
+        return self.segment(self.refinement9, second_out)
+
+    def decode_tiles(
+        self,
+        second_in: torch.Tensor,
+        mask: torch.Tensor,
+        pl3: torch.Tensor,
+        transfers: List[torch.Tensor],
+        tile_size: int,
+    ) -> torch.Tensor:
+        """Run the decoder only on the `tile_size` tiles that contain holes.
+
+        Every tile is decoded in a window with `decoder_halo` pixels of context on each side, which covers the
+        receptive field of the decoder, so the result inside the holes is the same as for the full decoder.
+        Outside of the hole tiles the output is the input image.
+        """
+        if tile_size % self.patch_size:
+            raise ValueError(f"tile_size should be a multiple of {self.patch_size}, got {tile_size}")
+
+        batch_size, _, height, width = mask.shape
+        window = tile_size + 2 * self.decoder_halo
+
+        batch_indices, _, rows, cols = torch.nonzero(F.max_pool2d(mask, tile_size, ceil_mode=True), as_tuple=True)
+
+        # decoding the whole image is cheaper
+        if window > min(height, width) or len(rows) * window**2 >= batch_size * height * width:
+            return self.decode(pl3, *transfers)
+
+        features = [pl3, *transfers]
+        scales = [8, 8, 4, 2]  # downsampling of the decoder inputs
+
+        # windows are shifted inside the image, so the padding at the image border is the same as for the full image
+        tops = (rows * tile_size - self.decoder_halo).clamp(0, height - window).tolist()
+        lefts = (cols * tile_size - self.decoder_halo).clamp(0, width - window).tolist()
+        tiles = list(
+            zip(batch_indices.tolist(), (rows * tile_size).tolist(), (cols * tile_size).tolist(), tops, lefts)
+        )
 
-    @staticmethod
-    def cal_patch(patch_num: int, mask: torch.Tensor, raw_size: int) -> torch.Tensor:
-        pool = nn.MaxPool2d(raw_size // patch_num)  # patch_num=32
-        return pool(mask)  # out: [B, 1, 32, 32]
-
-    def compute_attention(self, feature, patch_fb):  # in: [B, C:128, 64, 64]
-        b = feature.shape[0]
-        feature = F.interpolate(feature, scale_factor=0.5, mode="bilinear")  # in: [B, C:128, 32, 32]
-        p_fb = torch.reshape(patch_fb, [b, 32 * 32, 1])
-        p_matrix = torch.bmm(p_fb, (1 - p_fb).permute([0, 2, 1]))
-        f = feature.permute([0, 2, 3, 1]).reshape([b, 32 * 32, 128])
-        c = self.cosine_matrix(f, f) * p_matrix
-        return F.softmax(c, dim=2) * p_matrix
+        second_out = second_in.clone()
 
-    def attention_transfer(self, feature, attention):  # feature: [B, C, H, W]
-        batch_size, num_channels, height, width = feature.shape
-        f = self.extract_image_patches(feature, 32)
-        f = torch.reshape(f, [batch_size, f.shape[1] * f.shape[2], -1])
-        f = torch.bmm(attention, f)
-        f = torch.reshape(f, [batch_size, 32, 32, height // 32, width // 32, num_channels])
-        f = f.permute([0, 5, 1, 3, 2, 4])
-        return torch.reshape(f, [batch_size, num_channels, height, width])
+        for start in range(0, len(tiles), self.max_tiles_per_batch):
+            chunk = tiles[start : start + self.max_tiles_per_batch]
+
+            crops = [
+                torch.stack(
+                    [
+                        feature[b, :, top // scale : (top + window) // scale, left // scale : (left + window) // scale]
+                        for b, _, _, top, left in chunk
+                    ]
+                )
+                for feature, scale in zip(features, scales)
+            ]
+
+            out = self.decode(*crops)
+
+            for (b, y, x, top, left), tile_out in zip(chunk, out):
+                tile_height = min(tile_size, height - y)
+                tile_width = min(tile_size, width - x)
+                second_out[b, :, y : y + tile_height, x : x + tile_width] = tile_out[
+                    :, y - top : y - top + tile_height, x - left : x - left + tile_width
+                ]
+
+        return second_out
 
     @staticmethod
-    def extract_image_patches(img, patch_num):
-        batch_size, num_channels, height, width = img.shape
-        img = torch.reshape(
-            img, [batch_size, num_channels, patch_num, height // patch_num, patch_num, width // patch_num]
-        )
-        img = img.permute([0, 2, 4, 3, 5, 1])
-        return img
+    def pad(image: torch.Tensor, mask: torch.Tensor, multiple: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Pad image and mask on the bottom / right to a multiple of `multiple`, padding is not a hole."""
+        height, width = image.shape[2:]
+        pad = (0, (-width) % multiple, 0, (-height) % multiple)
+
+        if not any(pad):
+            return image, mask
+
+        return F.pad(image, pad, mode="replicate"), F.pad(mask, pad, value=0)
 
     @staticmethod
-    def cosine_matrix(matrix_a, matrix_b):
-        _matrixA_matrixB = torch.bmm(matrix_a, matrix_b.permute([0, 2, 1]))
-        _matrixA_norm = torch.sqrt((matrix_a * matrix_a).sum(axis=2)).unsqueeze(dim=2)
-        _matrixB_norm = torch.sqrt((matrix_b * matrix_b).sum(axis=2)).unsqueeze(dim=2)
-        return _matrixA_matrixB / torch.bmm(_matrixA_norm, _matrixB_norm.permute([0, 2, 1]))
+    def cal_patch(mask: torch.Tensor, patch_size: int) -> torch.Tensor:
+        return F.max_pool2d(mask, patch_size)  # out: [B, 1, H / patch_size, W / patch_size]
 
 
 class PatchDiscriminator(nn.Module):
     """
-    Input: generated image / ground truth and mask
+    Input: generated image / ground truth and mask, any size
     Output: patch based region, we set 30 * 30
     """
 
@@ -238,9 +489,17 @@ class PatchDiscriminator(nn.Module):
         x = self.block3(x)  # out: [B, 256, 64, 64]
         x = self.block4(x)  # out: [B, 256, 32, 32]
         x = self.block5(x)  # out: [B, 256, 16, 16]
-        x = self.block6(x)  # out: [B, 256, 8, 8]
-        x = x.reshape([x.shape[0], -1])
-        return self.block7(x)
+        x = self.block6(x)  # out: [B, 16, 8, 8]
+        if x.shape[2:] == (8, 8):  # 512 x 512 inputs
+            x = x.reshape([x.shape[0], -1])
+            return self.block7(x)
+
+        # block7 is the sum of the logits of the 8 x 8 patches, for another map size its weights are resized to the
+        # patches of the map and the patch logits are averaged: every patch has the same weight, and the output has
+        # the same scale as for 512 x 512 inputs
+        weight = F.adaptive_avg_pool2d(self.block7.weight.reshape(1, 16, 8, 8), x.shape[2:])
+        logits = (x * weight).sum(dim=1).flatten(1)
+        return logits.mean(dim=1, keepdim=True) * 64 + self.block7.bias
 
 
 class VGG16FeatureExtractor(nn.Module):
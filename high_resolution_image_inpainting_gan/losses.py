@@ -1,3 +1,5 @@
+from typing import List
+
 import torch
 from torch import nn
 
@@ -16,13 +18,28 @@ class Hinge(nn.Module):
 
 
 class Perceptual(nn.Module):
+    """L1 distance between VGG16 features of the prediction and the target.
+
+    Target features never need gradients and are computed without autograd. If the prediction does not need them
+    either, prediction and target go through VGG16 in one batched forward.
+    """
+
     def __init__(self) -> None:
         super().__init__()
         self.extractor = VGG16FeatureExtractor()
         self.l1 = nn.L1Loss()
 
     def forward(self, y_true: torch.Tensor, y_pred: torch.Tensor) -> torch.Tensor:
-        feat_pred = self.extractor(y_pred)
-        feat_gt = self.extractor(y_true)
+        if not (torch.is_grad_enabled() and y_pred.requires_grad):
+            features = self.extractor(torch.cat([y_pred, y_true]))
+            feat_pred = [x[: len(y_pred)] for x in features]
+            feat_gt = [x[len(y_pred) :] for x in features]
+        else:
+            feat_pred = self.extractor(y_pred)
+            feat_gt = self.get_target_features(y_true)
 
         return sum([self.l1(feat_pred[i], feat_gt[i]) for i in range(3)])
+
+    def get_target_features(self, y_true: torch.Tensor) -> List[torch.Tensor]:
+        with torch.no_grad():
+            return self.extractor(y_true)
@@ -0,0 +1,64 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from high_resolution_image_inpainting_gan.masks import StrokeMaskGenerator
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-o", "--output_path", type=Path, help="Path to save the mask bank, .npy file.", required=True)
+    arg("-n", "--num_masks", type=int, help="Number of masks.", default=100000)
+    arg("-s", "--size", type=int, help="Size of masks, multiple of 8.", default=512)
+    arg("-b", "--batch_size", type=int, help="Number of masks generated at once.", default=256)
+    arg("--seed", type=int, help="Random seed.", default=1984)
+    arg("--device", type=str, help="Device to run on.", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+def generate_batch(
+    mask_generator: StrokeMaskGenerator, batch_size: int, size: int, device: str, generator: torch.Generator
+) -> torch.Tensor:
+    """Masks of the batch, the last mask is checked against the same strokes drawn alone."""
+    segments, batch_indices = mask_generator.sample_segments(batch_size, size, size, device, generator)
+    masks = mask_generator.draw(segments, batch_indices, batch_size, size, size)
+
+    # the flat index of the last mask is the largest, the first to be wrong if it is not exact
+    last = batch_indices == batch_size - 1
+    expected = mask_generator.draw(segments[last], torch.zeros_like(batch_indices[last]), 1, size, size)
+    if not torch.equal(masks[-1:], expected):
+        raise RuntimeError("The last mask of the batch differs from the same strokes drawn alone.")
+
+    return masks
+
+
+def main():
+    """Generate stroke masks once and store them bit packed, 32 KB per 512 x 512 mask."""
+    args = get_args()
+
+    if args.size % 8:
+        raise ValueError(f"size should be a multiple of 8, got {args.size}")
+
+    mask_generator = StrokeMaskGenerator()
+    generator = torch.Generator(device=args.device)
+    generator.manual_seed(args.seed)
+
+    args.output_path.parent.mkdir(exist_ok=True, parents=True)
+    bank = np.lib.format.open_memmap(
+        args.output_path, mode="w+", dtype=np.uint8, shape=(args.num_masks, args.size, args.size // 8)
+    )
+
+    for start in tqdm(range(0, args.num_masks, args.batch_size)):
+        batch_size = min(args.batch_size, args.num_masks - start)
+        masks = generate_batch(mask_generator, batch_size, args.size, args.device, generator)
+        bank[start : start + batch_size] = np.packbits(masks[:, 0].cpu().numpy().astype(np.uint8), axis=-1)
+
+    bank.flush()
+
+
+if __name__ == "__main__":
+    main()
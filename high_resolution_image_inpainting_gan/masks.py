@@ -0,0 +1,131 @@
+import math
+from typing import Optional, Tuple, Union
+
+import torch
+
+
+class StrokeMaskGenerator:
+    """Batched version of iglovikov_helper_functions generate_stroke_mask that runs on any device.
+
+    Every stroke is a polyline of `max_vertex` segments at most, a segment with brush width w covers the pixels that
+    are closer than w / 2 to it, the same as the thick line of OpenCV. All segments of the batch are rasterized
+    together, in chunks of `segments_per_chunk`, every segment only in a box around it.
+
+    Output: [B, 1, H, W] float masks, 1 - hole, 0 - non hole, empty if no strokes are drawn
+    """
+
+    def __init__(
+        self,
+        parts: int = 7,
+        max_vertex: int = 25,
+        max_length: int = 80,
+        max_brush_width: int = 80,
+        max_angle: int = 360,
+        segments_per_chunk: int = 64,
+    ) -> None:
+        if min(parts, max_vertex, max_length, max_angle) < 0:
+            raise ValueError("parts, max_vertex, max_length and max_angle should be non negative.")
+        if max_brush_width < 10:
+            raise ValueError(f"max_brush_width should be at least 10, got {max_brush_width}.")
+        if segments_per_chunk < 1:
+            raise ValueError(f"segments_per_chunk should be positive, got {segments_per_chunk}.")
+
+        self.parts = parts
+        self.max_vertex = max_vertex
+        self.max_length = max_length
+        self.max_brush_width = max_brush_width
+        self.max_angle = max_angle
+        self.segments_per_chunk = segments_per_chunk
+
+    def __call__(
+        self,
+        batch_size: int,
+        height: int,
+        width: int,
+        device: Union[str, torch.device] = "cpu",
+        generator: Optional[torch.Generator] = None,
+    ) -> torch.Tensor:
+        segments, batch_indices = self.sample_segments(batch_size, height, width, device, generator)
+        return self.draw(segments, batch_indices, batch_size, height, width)
+
+    def sample_segments(
+        self,
+        batch_size: int,
+        height: int,
+        width: int,
+        device: Union[str, torch.device] = "cpu",
+        generator: Optional[torch.Generator] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Segments of the strokes [N, 5]: y0, x0, y1, x1, brush width, and the indices of their masks [N]."""
+        if self.parts == 0 or self.max_vertex == 0:
+            return torch.zeros(0, 5, device=device), torch.zeros(0, dtype=torch.long, device=device)
+
+        shape = (batch_size, self.parts)
+
+        def randint(low: int, high: int, size) -> torch.Tensor:
+            return torch.randint(low, high + 1, size, generator=generator, device=device)
+
+        num_vertex = randint(0, self.max_vertex, shape)
+        y = randint(0, height - 1, shape).float()
+        x = randint(0, width - 1, shape).float()
+
+        segments = []  # [B, parts, 5]: y0, x0, y1, x1, brush width
+        for i in range(self.max_vertex):
+            angle = torch.rand(shape, generator=generator, device=device) * math.radians(self.max_angle)
+            if i % 2 == 0:
+                angle = 2 * math.pi - angle
+
+            length = randint(0, self.max_length, shape)
+            brush_width = randint(10, self.max_brush_width, shape) // 2 * 2
+
+            next_y = (y + length * torch.cos(angle)).clamp(0, height - 1).floor()
+            next_x = (x + length * torch.sin(angle)).clamp(0, width - 1).floor()
+
+            segments.append(torch.stack([y, x, next_y, next_x, brush_width.float()], dim=-1))
+            y, x = next_y, next_x
+
+        all_segments = torch.stack(segments, dim=2)  # [B, parts, max_vertex, 5]
+        valid = torch.arange(self.max_vertex, device=device) < num_vertex[..., None]
+
+        batch_indices = torch.arange(batch_size, device=device)[:, None, None].expand_as(valid)[valid]
+        return all_segments[valid], batch_indices
+
+    def draw(
+        self, segments: torch.Tensor, batch_indices: torch.Tensor, batch_size: int, height: int, width: int
+    ) -> torch.Tensor:
+        """Masks of the segments of `sample_segments`, [B, 1, H, W]."""
+        device = segments.device
+        mask = torch.zeros(batch_size * height * width, device=device)
+
+        if len(segments) == 0:  # every stroke has 0 vertices
+            return mask.reshape(batch_size, 1, height, width)
+
+        # pixels of a segment are in the box of `half_size` around its center, similar boxes are processed together
+        center = torch.floor((segments[:, :2] + segments[:, 2:4]) / 2).long()
+        half_size = torch.ceil((segments[:, 2:4] - segments[:, :2]).abs() / 2 + segments[:, 4:] / 2) + 1
+        order = torch.argsort(half_size.prod(dim=1))
+
+        for chunk in torch.split(order, self.segments_per_chunk):
+            y0, x0, y1, x1, brush_width = segments[chunk, :, None, None].unbind(1)
+            dy, dx = y1 - y0, x1 - x0
+
+            # integer pixel coordinates, the flat index of B * H * W > 2 ** 24 pixels is not exact in float32
+            half_height, half_width = half_size[chunk].max(dim=0)[0].long().tolist()
+            pixel_y = (
+                center[chunk, 0, None, None] + torch.arange(-half_height, half_height + 1, device=device)[:, None]
+            )
+            pixel_x = center[chunk, 1, None, None] + torch.arange(-half_width, half_width + 1, device=device)[None, :]
+            grid_y, grid_x = pixel_y.float(), pixel_x.float()
+
+            # closest point of the segment to every pixel
+            t = ((grid_y - y0) * dy + (grid_x - x0) * dx) / (dy * dy + dx * dx).clamp(min=1)
+            t = t.clamp(0, 1)
+            distance = (grid_y - y0 - t * dy) ** 2 + (grid_x - x0 - t * dx) ** 2
+
+            hit = distance <= (brush_width / 2) ** 2
+            hit &= (pixel_y >= 0) & (pixel_y < height) & (pixel_x >= 0) & (pixel_x < width)
+
+            batch_offset = batch_indices[chunk, None, None] * height * width
+            mask[(batch_offset + pixel_y * width + pixel_x)[hit]] = 1
+
+        return mask.reshape(batch_size, 1, height, width)
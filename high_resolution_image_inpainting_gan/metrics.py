@@ -0,0 +1,102 @@
+"""Batched image quality metrics on the device, every metric returns a [B] tensor with a value per image.
+
+Images are [B, C, H, W] in range [0, 1], masks [B, 1, H, W] with 1 - hole, 0 - non hole. With a mask only the hole
+pixels are scored.
+"""
+
+from typing import Dict, Optional
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+
+def masked_mean(x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """Mean of [B, C, H, W] values per image, over the pixels with mask == 1 if the mask is set."""
+    if mask is None:
+        return x.mean(dim=(1, 2, 3))
+
+    mask = mask.expand_as(x)
+    return (x * mask).sum(dim=(1, 2, 3)) / mask.sum(dim=(1, 2, 3)).clamp(min=1)
+
+
+def l1(prediction: torch.Tensor, target: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+    return masked_mean((prediction - target).abs(), mask)
+
+
+def psnr(prediction: torch.Tensor, target: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+    mse = masked_mean((prediction - target) ** 2, mask)
+    return 10 * torch.log10(1 / mse.clamp(min=1e-10))
+
+
+def gaussian_window(window_size: int, sigma: float, like: torch.Tensor) -> torch.Tensor:
+    x = torch.arange(window_size, dtype=like.dtype, device=like.device) - window_size // 2
+    window = torch.exp(-(x**2) / (2 * sigma**2))
+    return window / window.sum()
+
+
+def ssim(
+    prediction: torch.Tensor,
+    target: torch.Tensor,
+    mask: Optional[torch.Tensor] = None,
+    window_size: int = 11,
+    sigma: float = 1.5,
+) -> torch.Tensor:
+    """Structural similarity with a gaussian window, the SSIM map is computed for the windows inside the image."""
+    num_channels = prediction.shape[1]
+    window = gaussian_window(window_size, sigma, prediction)
+
+    def blur(x: torch.Tensor) -> torch.Tensor:  # separable gaussian filter, no padding
+        x = F.conv2d(x, window.view(1, 1, -1, 1).repeat(num_channels, 1, 1, 1), groups=num_channels)
+        return F.conv2d(x, window.view(1, 1, 1, -1).repeat(num_channels, 1, 1, 1), groups=num_channels)
+
+    c1 = 0.01**2
+    c2 = 0.03**2
+
+    mu_x = blur(prediction)
+    mu_y = blur(target)
+    sigma_x = blur(prediction * prediction) - mu_x**2
+    sigma_y = blur(target * target) - mu_y**2
+    sigma_xy = blur(prediction * target) - mu_x * mu_y
+
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / ((mu_x**2 + mu_y**2 + c1) * (sigma_x + sigma_y + c2))
+
+    if mask is not None:
+        radius = window_size // 2
+        mask = mask[:, :, radius : mask.shape[2] - radius, radius : mask.shape[3] - radius]
+
+    return masked_mean(ssim_map, mask)
+
+
+def vgg_distance(extractor: nn.Module, prediction: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+    """LPIPS style distance: squared difference of channel normalized VGG16 features, averaged over the positions
+    and summed over the layers. `extractor` is the VGG16FeatureExtractor of the perceptual loss."""
+    features = extractor(torch.cat([prediction, target]))
+    distance = torch.zeros(prediction.shape[0], device=prediction.device)
+
+    for feature in features:
+        feature = feature / (feature.norm(dim=1, keepdim=True) + 1e-10)
+        feature_prediction, feature_target = torch.split(feature, prediction.shape[0])
+        distance += ((feature_prediction - feature_target) ** 2).sum(dim=1).mean(dim=(1, 2))
+
+    return distance
+
+
+def compute_metrics(
+    prediction: torch.Tensor, target: torch.Tensor, mask: torch.Tensor, extractor: Optional[nn.Module] = None
+) -> Dict[str, torch.Tensor]:
+    """Metrics of the whole images and of the holes only, values per image."""
+    with torch.no_grad():
+        metrics = {
+            "l1": l1(prediction, target),
+            "psnr": psnr(prediction, target),
+            "ssim": ssim(prediction, target),
+            "masked_l1": l1(prediction, target, mask),
+            "masked_psnr": psnr(prediction, target, mask),
+            "masked_ssim": ssim(prediction, target, mask),
+        }
+
+        if extractor is not None:
+            metrics["vgg"] = vgg_distance(extractor, prediction, target)
+
+    return metrics
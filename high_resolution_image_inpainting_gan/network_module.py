@@ -1,5 +1,8 @@
+from typing import Callable, Dict
+
 import torch
 from torch import nn
+from torch.nn import functional as F
 
 activation_dict = {
     "relu": nn.ReLU(inplace=True),
@@ -106,8 +109,6 @@ class GatedConv2d(nn.Module):
                 in_channels, out_channels, kernel_size, stride, padding=0, dilation=dilation
             )
 
-        self.sigmoid = torch.nn.Sigmoid()
-
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.pad(x)
         conv = self.conv2d(x)
@@ -116,5 +117,99 @@ class GatedConv2d(nn.Module):
             conv = self.norm(conv)
         if self.activation:
             conv = self.activation(conv)
-        gated_mask = self.sigmoid(mask)
+        # in place: the gate convolution does not keep its output for backward, the sigmoid keeps only its result
+        gated_mask = torch.sigmoid_(mask)
         return conv * gated_mask
+
+
+def elu_gate(x: torch.Tensor, gate: torch.Tensor) -> torch.Tensor:
+    return F.elu(x) * torch.sigmoid(gate)
+
+
+def relu_gate(x: torch.Tensor, gate: torch.Tensor) -> torch.Tensor:
+    return torch.relu(x) * torch.sigmoid(gate)
+
+
+def lrelu_gate(x: torch.Tensor, gate: torch.Tensor) -> torch.Tensor:
+    return F.leaky_relu(x, 0.2) * torch.sigmoid(gate)
+
+
+def identity_gate(x: torch.Tensor, gate: torch.Tensor) -> torch.Tensor:
+    return x * torch.sigmoid(gate)
+
+
+# activation * sigmoid(gate), keys are the classes in `activation_dict`
+fused_gate_dict = {nn.ELU: elu_gate, nn.ReLU: relu_gate, nn.LeakyReLU: lrelu_gate, type(None): identity_gate}
+
+scripted_gate_dict: Dict[type, Callable[[torch.Tensor, torch.Tensor], torch.Tensor]] = {}
+
+
+def get_fused_gate(key: type) -> Callable[[torch.Tensor, torch.Tensor], torch.Tensor]:
+    """Gate of `fused_gate_dict` as a single scripted elementwise op, scripted on the first use, not on import."""
+    if key not in scripted_gate_dict:
+        scripted_gate_dict[key] = torch.jit.script(fused_gate_dict[key])
+    return scripted_gate_dict[key]
+
+
+class FusedGatedConv2d(nn.Module):
+    """Inference version of GatedConv2d with the same weights.
+
+    With `single_channel_conv` the feature and the gate convolutions are merged into one convolution with
+    out_channels + 1 outputs. Activation, sigmoid and product are computed by one fused elementwise op.
+    """
+
+    def __init__(self, gated_conv: GatedConv2d) -> None:
+        super().__init__()
+        self.pad = gated_conv.pad
+        self.norm = gated_conv.norm
+
+        # key of the gate in `fused_gate_dict`, scripted functions as attributes break deepcopy of the model
+        if type(gated_conv.activation) in fused_gate_dict:
+            self.activation = None
+            self.gate_key = type(gated_conv.activation)
+        else:
+            self.activation = gated_conv.activation
+            self.gate_key = type(None)
+
+        self.single_channel_conv = isinstance(gated_conv.mask_conv2d, nn.Conv2d)
+
+        if self.single_channel_conv:
+            conv, mask_conv = gated_conv.conv2d, gated_conv.mask_conv2d
+            self.conv2d = nn.Conv2d(
+                conv.in_channels,
+                conv.out_channels + 1,
+                conv.kernel_size,
+                conv.stride,
+                padding=0,
+                dilation=conv.dilation,
+            )
+            with torch.no_grad():
+                self.conv2d.weight.copy_(torch.cat([conv.weight, mask_conv.weight]))
+                self.conv2d.bias.copy_(torch.cat([conv.bias, mask_conv.bias]))
+        else:
+            self.conv2d = gated_conv.conv2d
+            self.mask_conv2d = gated_conv.mask_conv2d
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = self.pad(x)
+        if self.single_channel_conv:
+            out = self.conv2d(x)
+            conv, mask = out[:, :-1], out[:, -1:]
+        else:
+            conv = self.conv2d(x)
+            mask = self.mask_conv2d(x)
+        if self.norm:
+            conv = self.norm(conv)
+        if self.activation:
+            conv = self.activation(conv)
+        return get_fused_gate(self.gate_key)(conv, mask)
+
+
+def fuse_gated_conv2d(model: nn.Module) -> nn.Module:
+    """Replace every GatedConv2d in the model with FusedGatedConv2d in place."""
+    for name, child in model.named_children():
+        if isinstance(child, GatedConv2d):
+            setattr(model, name, FusedGatedConv2d(child))
+        else:
+            fuse_gated_conv2d(child)
+    return model
@@ -0,0 +1,82 @@
+import argparse
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Tuple
+
+import cv2
+import numpy as np
+from iglovikov_helper_functions.utils.image_utils import load_rgb
+from tqdm import tqdm
+
+from high_resolution_image_inpainting_gan.dataset import IMAGE_EXTENSIONS
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-i", "--image_path", type=Path, help="Path to the folder with images.", required=True)
+    arg("-o", "--output_path", type=Path, help="Path to save shards.", required=True)
+    arg("-s", "--max_size", type=int, help="Size of the smallest side after resize.", default=512)
+    arg("--shard_size", type=float, help="Max size of a shard in GB.", default=4)
+    arg("-j", "--num_workers", type=int, help="Number of decode workers.", default=16)
+    return parser.parse_args()
+
+
+def load_resized(image_path: Path, max_size: int) -> np.ndarray:
+    """Same as albumentations SmallestMaxSize(max_size)."""
+    image = load_rgb(image_path)
+    height, width = image.shape[:2]
+    scale = max_size / min(height, width)
+
+    if scale == 1:
+        return image
+
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    return cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=interpolation)
+
+
+def load_resized_star(args: Tuple[Path, int]) -> np.ndarray:
+    return load_resized(*args)
+
+
+def main():
+    """Pack resized images as raw uint8 HWC arrays into large shards.
+
+    index.npy has a [shard, offset, height, width] row per image, ShardDataset reads images as memory mapped views.
+    """
+    args = get_args()
+
+    image_paths = sorted(x for x in args.image_path.rglob("*") if x.suffix.lower() in IMAGE_EXTENSIONS)
+    args.output_path.mkdir(exist_ok=True, parents=True)
+
+    max_shard_bytes = int(args.shard_size * 2**30)
+    index = np.zeros((len(image_paths), 4), dtype=np.int64)
+
+    shard_id = 0
+    offset = 0
+    shard = open(args.output_path / f"shard_{shard_id:05d}.bin", "wb")
+
+    with Pool(args.num_workers) as pool:
+        images = pool.imap(load_resized_star, ((x, args.max_size) for x in image_paths), chunksize=16)
+
+        for i, image in enumerate(tqdm(images, total=len(image_paths))):
+            if offset and offset + image.nbytes > max_shard_bytes:
+                shard.close()
+                shard_id += 1
+                offset = 0
+                shard = open(args.output_path / f"shard_{shard_id:05d}.bin", "wb")
+
+            shard.write(np.ascontiguousarray(image).tobytes())
+            index[i] = shard_id, offset, image.shape[0], image.shape[1]
+            offset += image.nbytes
+
+    shard.close()
+
+    np.save(args.output_path / "index.npy", index)
+
+    with open(args.output_path / "image_paths.txt", "w") as f:
+        f.write("\n".join(str(x.relative_to(args.image_path)) for x in image_paths))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+from torch import nn
+
+GENERATOR_BLOCKS = (
+    [f"coarse.coarse{i}" for i in range(1, 10)]
+    + [f"refinement{i}" for i in range(1, 7)]
+    + ["conv_pl3", "conv_pl2", "conv_pl1"]
+    + [f"refinement{i}" for i in range(7, 10)]
+)
+DISCRIMINATOR_BLOCKS = [f"block{i}" for i in range(1, 8)]
+STATS = ["calls", "forward_ms", "backward_ms", "memory_mb"]
+ATTENTION_METHODS = ["compute_attention", "attention_transfer", "chunked_attention_transfer"]
+
+
+def get_tensors(x: Any) -> List[torch.Tensor]:
+    if isinstance(x, torch.Tensor):
+        return [x]
+    if isinstance(x, (list, tuple)):
+        return [tensor for value in x for tensor in get_tensors(value)]
+    return []
+
+
+class BlockProfiler:
+    """Time and memory of the named blocks of GatedGenerator and PatchDiscriminator, summed over `num_steps` steps.
+
+    Forward time is measured between the start and the end of a block, backward time from the gradient of the block
+    output to the last gradient of its inputs and parameters. Memory is the increase of allocated cuda memory in the
+    forward, the size of the outputs on cpu. Hooks synchronize cuda in every block and are removed after `num_steps`.
+    """
+
+    def __init__(self, generator: nn.Module, discriminator: Optional[nn.Module] = None, num_steps: int = 50) -> None:
+        self.num_steps = num_steps
+        self.step_count = 0
+        self.stats: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.handles: List[Any] = []
+        self.backward_marks: Dict[str, float] = {}  # time of the last backward event of every block
+
+        self.attention = generator.attention
+        for method in ATTENTION_METHODS:
+            setattr(self.attention, method, self.wrap(f"attention.{method}", getattr(self.attention, method)))
+
+        generator_modules = dict(generator.named_modules())
+        for name in GENERATOR_BLOCKS:
+            self.add_block(name, generator_modules[name])
+
+        if discriminator is not None:
+            discriminator_modules = dict(discriminator.named_modules())
+            for name in DISCRIMINATOR_BLOCKS:
+                self.add_block(f"discriminator.{name}", discriminator_modules[name])
+
+    @property
+    def enabled(self) -> bool:
+        return self.step_count < self.num_steps
+
+    @staticmethod
+    def now(tensors: List[torch.Tensor]) -> float:
+        if tensors and tensors[0].is_cuda:
+            torch.cuda.synchronize(tensors[0].device)
+        return time.perf_counter()
+
+    @staticmethod
+    def memory(tensors: List[torch.Tensor]) -> float:
+        if tensors and tensors[0].is_cuda:
+            return torch.cuda.memory_allocated(tensors[0].device)
+        return 0
+
+    def start(self, inputs: Any) -> Dict[str, float]:
+        tensors = get_tensors(inputs)
+        return {"time": self.now(tensors), "memory": self.memory(tensors)}
+
+    def end(self, name: str, start: Dict[str, float], inputs: Any, outputs: Any) -> None:
+        tensors = get_tensors(outputs)
+        stats = self.stats[name]
+        stats["forward_ms"] += (self.now(tensors) - start["time"]) * 1000
+        stats["calls"] += 1
+
+        if tensors and tensors[0].is_cuda:
+            stats["memory_mb"] += (self.memory(tensors) - start["memory"]) / 2**20
+        else:
+            stats["memory_mb"] += sum(x.numel() * x.element_size() for x in tensors) / 2**20
+
+        if not torch.is_grad_enabled():
+            return
+
+        # hooks of non leaf tensors are released with the graph
+        for tensor in tensors:
+            if tensor.requires_grad:
+                tensor.register_hook(self.backward_start(name))
+
+        for tensor in get_tensors(inputs):
+            if tensor.requires_grad and not tensor.is_leaf:
+                tensor.register_hook(self.backward_end(name))
+
+    def backward_start(self, name: str) -> Callable[[torch.Tensor], None]:
+        def hook(grad: torch.Tensor) -> None:
+            self.backward_marks[name] = self.now([grad])
+
+        return hook
+
+    def backward_end(self, name: str) -> Callable[[torch.Tensor], None]:
+        """Every gradient of an input or a parameter of the block extends its backward time."""
+
+        def hook(grad: torch.Tensor) -> None:
+            if name in self.backward_marks and self.enabled:
+                current = self.now([grad])
+                self.stats[name]["backward_ms"] += (current - self.backward_marks[name]) * 1000
+                self.backward_marks[name] = current
+
+        return hook
+
+    def add_block(self, name: str, module: nn.Module) -> None:
+        starts: List[Dict[str, float]] = []
+
+        def pre_hook(module: nn.Module, inputs: Any) -> None:
+            if self.enabled:
+                starts.append(self.start(inputs))
+
+        def hook(module: nn.Module, inputs: Any, outputs: Any) -> None:
+            if self.enabled and starts:
+                self.end(name, starts.pop(), inputs, outputs)
+
+        self.handles.append(module.register_forward_pre_hook(pre_hook))
+        self.handles.append(module.register_forward_hook(hook))
+
+        for parameter in module.parameters():
+            if parameter.requires_grad:
+                self.handles.append(parameter.register_hook(self.backward_end(name)))
+
+    def wrap(self, name: str, function: Callable) -> Callable:
+        def wrapped(*args, **kwargs):
+            if not self.enabled:
+                return function(*args, **kwargs)
+
+            start = self.start(args)
+            outputs = function(*args, **kwargs)
+            self.end(name, start, args, outputs)
+            return outputs
+
+        return wrapped
+
+    def step(self) -> bool:
+        """Call after every training step, True if the last profiled step is done."""
+        if not self.enabled:
+            return False
+
+        self.step_count += 1
+        if self.enabled:
+            return False
+
+        self.close()
+        return True
+
+    def close(self) -> None:
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+        for method in ATTENTION_METHODS:
+            self.attention.__dict__.pop(method, None)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Per step averages of every block that was called."""
+        num_steps = max(self.step_count, 1)
+        return {name: {key: stats[key] / num_steps for key in STATS} for name, stats in self.stats.items()}
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            f"profile/{name}/{key}": value
+            for name, stats in self.summary().items()
+            for key, value in stats.items()
+            if key != "calls"
+        }
+
+    def table(self) -> str:
+        summary = self.summary()
+        total = sum(x["forward_ms"] + x["backward_ms"] for x in summary.values()) or 1
+
+        lines = [f"{'block':<40}{'calls':>8}{'forward ms':>12}{'backward ms':>13}{'memory MB':>11}{'time %':>8}"]
+        for name, stats in summary.items():
+            share = (stats["forward_ms"] + stats["backward_ms"]) / total * 100
+            lines.append(
+                f"{name:<40}{stats['calls']:>8.1f}{stats['forward_ms']:>12.2f}{stats['backward_ms']:>13.2f}"
+                f"{stats['memory_mb']:>11.1f}{share:>8.1f}"
+            )
+
+        return "\n".join(lines)
@@ -0,0 +1,262 @@
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import torch
+
+from high_resolution_image_inpainting_gan.inpainting_network import GatedGenerator
+
+Box = Tuple[int, int, int, int]  # y0, y1, x0, x1 in input pixels
+
+
+class CacheEntry:
+    def __init__(self, coarse_mask: torch.Tensor, first_out: torch.Tensor) -> None:
+        self.coarse_mask = coarse_mask
+        self.first_out = first_out
+
+        # refinement encoder features pl1, pl2, pl3 and the mask they were computed for
+        self.features_mask: Optional[torch.Tensor] = None
+        self.features: List[torch.Tensor] = []
+
+        # attention transfers of pl3, pl2, pl1 and the refined output for `features_mask`, see IncrementalInpainter
+        self.transfers: List[torch.Tensor] = []
+        self.second_out: Optional[torch.Tensor] = None
+
+
+class ProgressiveInpainter:
+    """
+    Input: image in range [0, 1] + mask (1 - hole, 0 - non hole)
+    Output: `coarse` - image with holes filled by the coarse network, `refine` - by the refinement network
+
+    For interactive editing: the cheap coarse result is returned first and the refined one later. The coarse output
+    and the refinement encoder features of the last `cache_size` images are cached by image hash. When the mask of
+    a cached image changes, they are recomputed only around the changed pixels, in windows with `halo` pixels of
+    context. The default halo is the receptive field and gives the same results as GatedGenerator, a smaller halo
+    is faster and slightly different near the changed pixels.
+    """
+
+    coarse_receptive_field = 704  # input pixels, multiples of the patch size
+    encoder_receptive_field = 272
+
+    def __init__(self, generator: GatedGenerator, cache_size: int = 16, halo: Optional[int] = None) -> None:
+        self.generator = generator
+        self.cache_size = cache_size
+        self.coarse_halo = self.coarse_receptive_field if halo is None else halo
+        self.encoder_halo = self.encoder_receptive_field if halo is None else halo
+        self.cache: "OrderedDict[str, CacheEntry]" = OrderedDict()
+
+    def __call__(self, image: torch.Tensor, mask: torch.Tensor) -> Iterator[torch.Tensor]:
+        yield self.coarse(image, mask)
+        yield self.refine(image, mask)
+
+    @torch.no_grad()
+    def coarse(self, image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        height, width = image.shape[2:]
+        padded_image, padded_mask = self.generator.pad(image, mask, self.generator.patch_size)
+
+        first_out = self.get_entry(padded_image, padded_mask).first_out[:, :, :height, :width]
+        return image * (1 - mask) + first_out * mask
+
+    @torch.no_grad()
+    def refine(self, image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        height, width = image.shape[2:]
+        padded_image, padded_mask = self.generator.pad(image, mask, self.generator.patch_size)
+
+        entry = self.get_entry(padded_image, padded_mask)
+        self.update_features(entry, padded_image, padded_mask)
+        pl1, pl2, pl3 = entry.features
+
+        patch_fb = self.generator.cal_patch(padded_mask, self.generator.patch_size)
+        transfers = self.generator.attention(pl3, patch_fb, [pl3, pl2, pl1])
+
+        second_in = padded_image * (1 - padded_mask) + entry.first_out * padded_mask
+        if self.generator.sparse_tile_size is not None:
+            second_out = self.generator.decode_tiles(
+                second_in, padded_mask, pl3, transfers, self.generator.sparse_tile_size
+            )
+        else:
+            second_out = self.generator.decode(pl3, *transfers)
+
+        second_out = second_out[:, :, :height, :width]
+        return image * (1 - mask) + second_out * mask
+
+    def get_entry(self, image: torch.Tensor, mask: torch.Tensor) -> CacheEntry:
+        """Cache entry of the image with the coarse output for the mask."""
+        key = f"{tuple(image.shape)} {hashlib.sha1(image.cpu().numpy().tobytes()).hexdigest()}"
+
+        if key not in self.cache:
+            self.cache[key] = CacheEntry(mask, self.generator.coarse_forward(image, mask))
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return self.cache[key]
+
+        self.cache.move_to_end(key)
+        entry = self.cache[key]
+
+        box = self.get_dirty_box(entry.coarse_mask, mask)
+        if box is not None:
+            box = self.expand(box, self.coarse_halo, mask)
+            (entry.first_out,) = self.recompute(
+                lambda x, y: [self.generator.coarse_forward(x, y)],
+                [image, mask],
+                [entry.first_out],
+                box,
+                self.coarse_halo,
+                mask,
+            )
+            entry.coarse_mask = mask
+
+        return entry
+
+    def update_features(self, entry: CacheEntry, image: torch.Tensor, mask: torch.Tensor) -> None:
+        second_in = image * (1 - mask) + entry.first_out * mask
+
+        if entry.features_mask is None:
+            entry.features = list(self.generator.encode(second_in))
+            entry.features_mask = mask
+            return
+
+        box = self.get_dirty_box(entry.features_mask, mask)
+        if box is None:
+            return
+
+        # the coarse output changed around the changed pixels, the features around the changed coarse output
+        box = self.expand(self.expand(box, self.coarse_halo, mask), self.encoder_halo, mask)
+        entry.features = self.recompute(
+            self.generator.encode, [second_in], entry.features, box, self.encoder_halo, mask
+        )
+        entry.features_mask = mask
+
+    def recompute(
+        self,
+        function: Callable[..., List[torch.Tensor]],
+        inputs: List[torch.Tensor],
+        previous: List[torch.Tensor],
+        box: Box,
+        halo: int,
+        like: torch.Tensor,
+    ) -> List[torch.Tensor]:
+        """Outputs of the function in the box, computed on the box with the halo, the rest is from `previous`.
+
+        The box is in pixels of `like`, inputs and outputs may be downsampled.
+        """
+        height = like.shape[2]
+        window = self.expand(box, halo, like)
+        outputs = function(*[self.crop(x, window, height // x.shape[2]) for x in inputs])
+
+        results = []
+        for output, previous_output in zip(outputs, previous):
+            scale = height // previous_output.shape[2]
+            y0, y1, x0, x1 = [x // scale for x in box]
+            dy, dx = window[0] // scale, window[2] // scale
+
+            result = previous_output.clone()
+            result[:, :, y0:y1, x0:x1] = output[:, :, y0 - dy : y1 - dy, x0 - dx : x1 - dx]
+            results.append(result)
+
+        return results
+
+    @staticmethod
+    def crop(x: torch.Tensor, box: Box, scale: int) -> torch.Tensor:
+        return x[:, :, box[0] // scale : box[1] // scale, box[2] // scale : box[3] // scale]
+
+    @staticmethod
+    def get_dirty_box(previous_mask: torch.Tensor, mask: torch.Tensor) -> Optional[Box]:
+        changed = (previous_mask != mask).any(dim=0).any(dim=0)
+        if not changed.any():
+            return None
+
+        rows = changed.any(dim=1).nonzero()
+        cols = changed.any(dim=0).nonzero()
+        return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+
+    def expand(self, box: Box, margin: int, like: torch.Tensor) -> Box:
+        """Box with the margin, aligned to the patch size, inside the image."""
+        height, width = like.shape[2:]
+        patch_size = self.generator.patch_size
+
+        y0 = max(0, (box[0] - margin) // patch_size * patch_size)
+        x0 = max(0, (box[2] - margin) // patch_size * patch_size)
+        y1 = min(height, -((-box[1] - margin) // patch_size) * patch_size)
+        x1 = min(width, -((-box[3] - margin) // patch_size) * patch_size)
+        return y0, y1, x0, x1
+
+
+class IncrementalInpainter(ProgressiveInpainter):
+    """
+    Input: image in range [0, 1] + mask (1 - hole, 0 - non hole)
+    Output: `coarse` - image with holes filled by the coarse network, `refine` - by the refinement network
+
+    For mask editing stroke by stroke: the previous mask and refined output of the image are cached too, and after a
+    change of the mask the whole refinement is rerun only around the changed pixels. The coarse network and the
+    encoder run in windows as in ProgressiveInpainter, the attention recomputes only the rows of the hole patches with
+    changed features and the decoder runs in a window around them, the results are spliced into the cached ones.
+
+    The other hole patches keep the attention of the previous mask, so unlike ProgressiveInpainter the result differs
+    from a full pass even with the default halo. Use `halo` of 32 - 64 pixels, the default one spans the whole image
+    for images up to ~1.5K.
+    """
+
+    @torch.no_grad()
+    def refine(self, image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        height, width = image.shape[2:]
+        padded_image, padded_mask = self.generator.pad(image, mask, self.generator.patch_size)
+
+        entry = self.get_entry(padded_image, padded_mask)
+        previous_mask = entry.features_mask
+
+        if entry.second_out is None or previous_mask is None:
+            self.update_features(entry, padded_image, padded_mask)
+            self.refine_full(entry, padded_image, padded_mask)
+        else:
+            box = self.get_dirty_box(previous_mask, padded_mask)
+            if box is not None:
+                self.update_features(entry, padded_image, padded_mask)
+                # the same box as in update_features: the features changed in it
+                box = self.expand(self.expand(box, self.coarse_halo, padded_mask), self.encoder_halo, padded_mask)
+                self.refine_box(entry, padded_mask, box)
+
+        second_out = entry.second_out[:, :, :height, :width]
+        return image * (1 - mask) + second_out * mask
+
+    def refine_full(self, entry: CacheEntry, image: torch.Tensor, mask: torch.Tensor) -> None:
+        pl1, pl2, pl3 = entry.features
+
+        patch_fb = self.generator.cal_patch(mask, self.generator.patch_size)
+        entry.transfers = self.generator.attention(pl3, patch_fb, [pl3, pl2, pl1])
+
+        second_in = image * (1 - mask) + entry.first_out * mask
+        if self.generator.sparse_tile_size is not None:
+            entry.second_out = self.generator.decode_tiles(
+                second_in, mask, pl3, entry.transfers, self.generator.sparse_tile_size
+            )
+        else:
+            entry.second_out = self.generator.decode(pl3, *entry.transfers)
+
+    def refine_box(self, entry: CacheEntry, mask: torch.Tensor, box: Box) -> None:
+        """Update the transfers and the output after the features changed in the box."""
+        pl1, pl2, pl3 = entry.features
+        patch_size = self.generator.patch_size
+
+        patch_fb = self.generator.cal_patch(mask, patch_size)
+        queries = torch.zeros_like(patch_fb)
+        queries[:, :, box[0] // patch_size : box[1] // patch_size, box[2] // patch_size : box[3] // patch_size] = 1
+
+        transfers = self.generator.attention.chunked_attention_transfer(pl3, patch_fb, [pl3, pl2, pl1], queries)
+
+        # hole patches outside of the box keep the previous transfers, inside it the new ones or zero for non holes
+        for transfer, previous_transfer in zip(transfers, entry.transfers):
+            scale = mask.shape[2] // transfer.shape[2]
+            y0, y1, x0, x1 = [x // scale for x in box]
+            previous_transfer[:, :, y0:y1, x0:x1] = transfer[:, :, y0:y1, x0:x1]
+
+        # the decoder output changed in the box with the receptive field of the decoder
+        decoder_box = self.expand(box, self.generator.decoder_halo, mask)
+        (entry.second_out,) = self.recompute(
+            lambda *x: [self.generator.decode(*x)],
+            [pl3, *entry.transfers],
+            [entry.second_out],
+            decoder_box,
+            self.generator.decoder_halo,
+            mask,
+        )
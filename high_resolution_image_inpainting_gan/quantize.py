@@ -0,0 +1,198 @@
+import argparse
+import copy
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import torch
+import yaml
+from addict import Dict as Adict
+from iglovikov_helper_functions.utils.image_utils import load_rgb
+from torch import nn
+
+from high_resolution_image_inpainting_gan import metrics
+from high_resolution_image_inpainting_gan.dataset import IMAGE_EXTENSIONS
+from high_resolution_image_inpainting_gan.inference import Inpainter, load_generator
+from high_resolution_image_inpainting_gan.masks import StrokeMaskGenerator
+from high_resolution_image_inpainting_gan.network_module import (
+    DepthWiseSeparableConv,
+    FusedGatedConv2d,
+    GatedConv2d,
+)
+
+Batch = Tuple[torch.Tensor, torch.Tensor]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-c", "--config_path", type=Path, help="Path to the config.", required=True)
+    arg("-w", "--checkpoint_path", type=Path, help="Path to the checkpoint.", required=True)
+    arg(
+        "-i",
+        "--image_path",
+        type=Path,
+        help="Path to the folder with calibration and evaluation images.",
+        required=True,
+    )
+    arg("-m", "--mask_path", type=Path, help="Folder with png masks, stroke masks are generated if not set.")
+    arg("-o", "--output_path", type=Path, help="Path to save the quantized TorchScript model.", required=True)
+    arg("-s", "--size", type=int, help="Images are resized to size x size.", default=512)
+    arg("--num_calibration", type=int, help="Number of calibration images.", default=32)
+    arg("--num_eval", type=int, help="Number of evaluation images.", default=16)
+    arg("-b", "--batch_size", type=int, help="Batch size.", default=4)
+    arg("--backend", choices=["fbgemm", "qnnpack"], help="fbgemm - x86, qnnpack - arm.", default="fbgemm")
+    arg("--fuse", action="store_true", help="Quantize fused gated convolutions.")
+    arg("--channels_last", action="store_true", help="Also evaluate channels last models.")
+    return parser.parse_args()
+
+
+def prepare_quantization(model: nn.Module, backend: str = "fbgemm") -> nn.Module:
+    """Add quant / dequant stubs around the convolutions of gated convolutions and observers, in place.
+
+    Convolutions run in int8, with per-channel weights on fbgemm. Depthwise convolutions of the gates stay float,
+    quantized depthwise convolutions are several times slower than float ones. Padding, activation, sigmoid
+    gating, upsampling and the attention stay float.
+    """
+    torch.backends.quantized.engine = backend
+    qconfig = torch.quantization.get_default_qconfig(backend)
+
+    for module in list(model.modules()):
+        if isinstance(module, DepthWiseSeparableConv):
+            parent, name = module, "point_conv"
+        elif isinstance(module, (GatedConv2d, FusedGatedConv2d)):
+            parent, name = module, "conv2d"
+        else:
+            continue
+
+        wrapper = torch.quantization.QuantWrapper(getattr(parent, name))
+        wrapper.qconfig = qconfig
+        setattr(parent, name, wrapper)
+
+        # single channel gate convolution, not merged into conv2d
+        if isinstance(getattr(module, "mask_conv2d", None), nn.Conv2d):
+            wrapper = torch.quantization.QuantWrapper(module.mask_conv2d)
+            wrapper.qconfig = qconfig
+            module.mask_conv2d = wrapper
+
+    return torch.quantization.prepare(model.eval(), inplace=True)
+
+
+def quantize_generator(generator: nn.Module, batches: List[Batch], backend: str = "fbgemm") -> nn.Module:
+    """Post training int8 quantization of a copy of the generator, calibrated on (image, mask) batches."""
+    model = prepare_quantization(copy.deepcopy(generator), backend)
+
+    with torch.no_grad():
+        for image, mask in batches:
+            model(image, mask)
+
+    return torch.quantization.convert(model, inplace=True)
+
+
+def load_batches(
+    image_paths: List[Path], image_path: Path, mask_path: Optional[Path], size: int, batch_size: int
+) -> List[Batch]:
+    images = []
+    masks = []
+
+    for file_path in image_paths:
+        images.append(cv2.resize(load_rgb(file_path), (size, size), interpolation=cv2.INTER_AREA))
+
+        if mask_path is not None:
+            mask = cv2.imread(str(mask_path / file_path.relative_to(image_path).with_suffix(".png")), 0)
+            masks.append(cv2.resize(mask, (size, size), interpolation=cv2.INTER_NEAREST) > 127)
+
+    image_tensor = torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).float() / 255
+
+    if mask_path is None:
+        generator = torch.Generator()
+        generator.manual_seed(0)
+        mask_tensor = StrokeMaskGenerator()(len(images), size, size, generator=generator)
+    else:
+        mask_tensor = torch.from_numpy(np.stack(masks))[:, None].float()
+
+    return list(zip(torch.split(image_tensor, batch_size), torch.split(mask_tensor, batch_size)))
+
+
+def masked_errors(prediction: torch.Tensor, target: torch.Tensor, mask: torch.Tensor) -> Tuple[float, float]:
+    """Mean L1 and PSNR of the holes."""
+    return float(metrics.l1(prediction, target, mask).mean()), float(metrics.psnr(prediction, target, mask).mean())
+
+
+def evaluate(model: nn.Module, batches: List[Batch], channels_last: bool) -> Tuple[torch.Tensor, float]:
+    """Results and mean latency of a batch in ms."""
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    results = []
+    latencies = []
+
+    with torch.no_grad():
+        model(*batches[0])  # warm up
+
+        for image, mask in batches:
+            image = image.contiguous(memory_format=memory_format)
+            mask = mask.contiguous(memory_format=memory_format)
+
+            start = time.perf_counter()
+            results.append(model(image, mask))
+            latencies.append(time.perf_counter() - start)
+
+    return torch.cat(results).contiguous(), float(np.mean(latencies) * 1000)
+
+
+def main():
+    """Quantize the generator to int8 for cpu serving and compare speed and quality with the float model."""
+    args = get_args()
+
+    with open(args.config_path) as f:
+        config = Adict(yaml.load(f, Loader=yaml.SafeLoader))
+
+    image_paths = sorted(x for x in args.image_path.rglob("*") if x.suffix.lower() in IMAGE_EXTENSIONS)
+    image_paths = image_paths[: args.num_calibration + args.num_eval]
+
+    if len(image_paths) <= args.num_calibration:
+        raise ValueError(f"Need more than {args.num_calibration} images, found {len(image_paths)}.")
+
+    calibration = load_batches(
+        image_paths[: args.num_calibration], args.image_path, args.mask_path, args.size, args.batch_size
+    )
+    evaluation = load_batches(
+        image_paths[args.num_calibration :], args.image_path, args.mask_path, args.size, args.batch_size
+    )
+
+    generator = load_generator(config, args.checkpoint_path, args.fuse)
+    quantized = quantize_generator(generator, calibration, args.backend)
+
+    models: Dict[str, Tuple[nn.Module, bool]] = {
+        "float": (Inpainter(generator), False),
+        "int8": (Inpainter(quantized), False),
+    }
+
+    if args.channels_last:
+        models["float channels last"] = (copy.deepcopy(models["float"][0]).to(memory_format=torch.channels_last), True)
+        models["int8 channels last"] = (copy.deepcopy(models["int8"][0]).to(memory_format=torch.channels_last), True)
+
+    images = torch.cat([x[0] for x in evaluation])
+    masks = torch.cat([x[1] for x in evaluation])
+
+    results = {name: evaluate(model, evaluation, channels_last) for name, (model, channels_last) in models.items()}
+    float_result, float_latency = results["float"]
+
+    columns = ["batch ms", "speedup", "L1 float", "PSNR float", "L1 image", "PSNR image"]
+    print(f"{'model':<24}" + "".join(f"{x:>12}" for x in columns))
+    for name, (result, latency) in results.items():
+        l1_float, psnr_float = masked_errors(result, float_result, masks)
+        l1_image, psnr_image = masked_errors(result, images, masks)
+        print(
+            f"{name:<24}{latency:>12.1f}{float_latency / latency:>12.2f}{l1_float:>12.4f}{psnr_float:>12.2f}"
+            f"{l1_image:>12.4f}{psnr_image:>12.2f}"
+        )
+
+    args.output_path.parent.mkdir(exist_ok=True, parents=True)
+    traced = torch.jit.trace(models["int8"][0], evaluation[0])
+    traced.save(str(args.output_path))
+
+
+if __name__ == "__main__":
+    main()
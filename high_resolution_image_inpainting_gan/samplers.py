@@ -0,0 +1,157 @@
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def get_bucket_shapes(size: int, aspect_ratios: Sequence[float], multiple: int = 64) -> List[Tuple[int, int]]:
+    """(height, width) of the buckets, about the area of the `size` x `size` square, aspect ratio is width / height."""
+    shapes = []
+    for aspect_ratio in aspect_ratios:
+        height = max(multiple, round(size / np.sqrt(aspect_ratio) / multiple) * multiple)
+        width = max(multiple, round(size * np.sqrt(aspect_ratio) / multiple) * multiple)
+        shapes.append((height, width))
+    return shapes
+
+
+def get_buckets(aspect_ratios: np.ndarray, shapes: Sequence[Tuple[int, int]]) -> np.ndarray:
+    """Index of the bucket with the closest aspect ratio for every image."""
+    bucket_aspect_ratios = np.array([width / height for height, width in shapes])
+    return np.abs(np.log(aspect_ratios)[:, None] - np.log(bucket_aspect_ratios)[None]).argmin(axis=1)
+
+
+class EpochSampler(Sampler, ABC):
+    """Sampler with an order that depends on the seed and the epoch only and can resume in the middle of an epoch.
+
+    Every pass over the sampler is the next epoch. `state_dict` is the position after the batches consumed in the
+    current pass, saved in the checkpoint, after `load_state_dict` the next pass continues from that position.
+    The position depends on the batch size, a state of a finished epoch or of another batch size, e.g. of the previous
+    curriculum stage, starts the next epoch. Epochs of the sampler are counted separately from the epochs of the
+    trainer.
+    """
+
+    def __init__(  # pylint: disable=W0231
+        self, batch_size: int, seed: int = 0, num_replicas: int = 1, rank: int = 0
+    ) -> None:
+        self.batch_size = batch_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+        self.epoch = 0
+        self.start = 0
+        self.current = (0, 0)  # epoch and start of the current pass
+
+    @abstractmethod
+    def get_items(self, epoch: int) -> List[Any]:
+        """All items of the rank in the epoch."""
+
+    def num_items(self, num_batches: int) -> int:
+        return num_batches
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of items of the rank in an epoch."""
+
+    def __iter__(self) -> Iterator[Any]:
+        if self.start >= len(self):  # the previous epoch was finished
+            self.epoch += 1
+            self.start = 0
+
+        self.current = (self.epoch, self.start)
+        items = self.get_items(self.epoch)[self.start :]
+
+        self.epoch += 1
+        self.start = 0
+        return iter(items)
+
+    def state_dict(self, num_batches: int) -> Dict[str, int]:
+        """Position after `num_batches` batches of the current pass."""
+        epoch, start = self.current
+        position = start + self.num_items(num_batches)
+        return {"epoch": epoch, "position": position, "finished": position >= len(self), "batch_size": self.batch_size}
+
+    def load_state_dict(self, state: Optional[Dict[str, int]]) -> None:
+        if state is None:
+            return
+
+        if state["finished"] or state["batch_size"] != self.batch_size:
+            self.epoch = state["epoch"] + 1
+            self.start = 0
+        else:
+            self.epoch = state["epoch"]
+            self.start = state["position"]
+
+
+class ResumableSampler(EpochSampler):
+    """Seeded random order of the dataset, sharded between the ranks.
+
+    An epoch has `epoch_length` samples of all ranks, by default the size of the dataset, longer epochs concatenate
+    several permutations of the dataset. Every rank gets every `num_replicas`-th sample of the epoch, the same number
+    of samples on all ranks, rounded down to full batches.
+    """
+
+    def __init__(
+        self,
+        dataset_size: int,
+        batch_size: int,
+        epoch_length: Optional[int] = None,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ) -> None:
+        super().__init__(batch_size, seed, num_replicas, rank)
+        self.dataset_size = dataset_size
+        self.epoch_length = epoch_length or dataset_size
+
+    def get_items(self, epoch: int) -> List[int]:
+        rng = np.random.default_rng([self.seed, epoch])
+
+        num_samples = len(self) * self.num_replicas
+        num_permutations = -(-num_samples // self.dataset_size)
+        indices = np.concatenate([rng.permutation(self.dataset_size) for _ in range(num_permutations)])
+        return indices[self.rank : num_samples : self.num_replicas].tolist()
+
+    def num_items(self, num_batches: int) -> int:
+        return num_batches * self.batch_size
+
+    def __len__(self) -> int:
+        return self.epoch_length // self.num_replicas // self.batch_size * self.batch_size
+
+
+class AspectRatioBatchSampler(EpochSampler):
+    """Batches of images of the same aspect ratio bucket, see BucketDataset.
+
+    Every epoch the images of every bucket are shuffled and split into batches, incomplete batches are dropped, and
+    the batches of all buckets are shuffled. With `num_replicas` > 1 every rank gets every `num_replicas`-th batch,
+    the same number of batches on all ranks.
+    """
+
+    def __init__(
+        self,
+        buckets: np.ndarray,
+        batch_size: int,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ) -> None:
+        super().__init__(batch_size, seed, num_replicas, rank)
+        self.buckets = buckets
+
+    def get_items(self, epoch: int) -> List[List[int]]:
+        rng = np.random.default_rng([self.seed, epoch])
+
+        batches = []
+        for bucket in np.unique(self.buckets):
+            indices = rng.permutation(np.flatnonzero(self.buckets == bucket))
+            num_batches = len(indices) // self.batch_size
+            batches += np.split(indices[: num_batches * self.batch_size], num_batches) if num_batches else []
+
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+        num_batches = len(batches) // self.num_replicas * self.num_replicas
+        return [x.tolist() for x in batches[self.rank : num_batches : self.num_replicas]]
+
+    def __len__(self) -> int:
+        num_batches = sum(x // self.batch_size for x in np.bincount(self.buckets))
+        return num_batches // self.num_replicas
@@ -0,0 +1,212 @@
+import argparse
+import base64
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent import futures
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Tuple
+
+import cv2
+import numpy as np
+import torch
+import yaml
+from addict import Dict as Adict
+from torch import nn
+
+from high_resolution_image_inpainting_gan.cra import ContextualResidualAggregation
+from high_resolution_image_inpainting_gan.inference import (
+    Inpainter,
+    collate_bucket,
+    get_bucket,
+    load_generator,
+)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg("-c", "--config_path", type=Path, help="Path to the config.", required=True)
+    arg("-w", "--checkpoint_path", type=Path, help="Path to the checkpoint.", required=True)
+    arg("--host", type=str, help="Host to listen on.", default="0.0.0.0")
+    arg("--port", type=int, help="Port to listen on.", default=8000)
+    arg("-b", "--max_batch_size", type=int, help="Max number of requests in a batch.", default=8)
+    arg("--max_wait", type=float, help="Max time a request waits for a batch, ms.", default=10)
+    arg("--timeout", type=float, help="Max time a request waits for the result, s, 503 after it.", default=60)
+    arg("--mode", choices=["direct", "cra"], help="cra - contextual residual aggregation.", default="direct")
+    arg("--low_resolution", type=int, help="Resolution of the generator pass in the cra mode.", default=512)
+    arg("--fuse", action="store_true", help="Use fused gated convolutions.")
+    arg("--device", type=str, help="Device to run on.", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+class Request(NamedTuple):
+    image: np.ndarray  # [H, W, 3] uint8 RGB
+    mask: np.ndarray  # [H, W] bool, True - hole
+    future: Future
+    arrival: float
+
+
+class DynamicBatcher:
+    """Runs concurrent requests of the same size bucket in one batch.
+
+    A bucket is run when it has `max_batch_size` requests or when its oldest request waited `max_wait` seconds,
+    so a single request is delayed by `max_wait` at most. All batches are run by one thread, an exception in a batch
+    is set on the futures of its requests and the thread keeps running.
+    """
+
+    def __init__(
+        self, model: nn.Module, device: str, bucket_multiple: int, max_batch_size: int = 8, max_wait: float = 0.01
+    ) -> None:
+        self.model = model
+        self.device = device
+        self.bucket_multiple = bucket_multiple
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.queue: "queue.Queue[Request]" = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image: np.ndarray, mask: np.ndarray) -> Future:
+        future: Future = Future()
+        self.queue.put(Request(image, mask, future, time.monotonic()))
+        return future
+
+    def run(self) -> None:
+        buckets: Dict[Tuple[int, int], List[Request]] = defaultdict(list)
+
+        while True:
+            if buckets:
+                deadline = min(x[0].arrival for x in buckets.values()) + self.max_wait
+                timeout = max(deadline - time.monotonic(), 0)
+            else:
+                timeout = None
+
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                request = None
+
+            # requests that arrived while the previous batch was running are grouped without waiting
+            while request is not None:
+                bucket = get_bucket(*request.image.shape[:2], self.bucket_multiple)
+                buckets[bucket].append(request)
+
+                if len(buckets[bucket]) == self.max_batch_size:
+                    self.run_batch(bucket, buckets.pop(bucket))
+
+                try:
+                    request = self.queue.get_nowait()
+                except queue.Empty:
+                    request = None
+
+            now = time.monotonic()
+            for bucket in [x for x, requests in buckets.items() if requests[0].arrival + self.max_wait <= now]:
+                self.run_batch(bucket, buckets.pop(bucket))
+
+    def run_batch(self, bucket: Tuple[int, int], requests: List[Request]) -> None:
+        try:
+            images = [torch.from_numpy(x.image).to(self.device).permute(2, 0, 1).float() / 255 for x in requests]
+            masks = [torch.from_numpy(x.mask).to(self.device)[None].float() for x in requests]
+            images_batch, masks_batch = collate_bucket(images, masks, bucket)
+
+            with torch.no_grad():
+                result = self.model(images_batch, masks_batch)
+
+            result = (result * 255).round().clamp(0, 255).byte().permute(0, 2, 3, 1).cpu().numpy()
+        except Exception as e:  # pylint: disable=W0703
+            for request in requests:
+                request.future.set_exception(e)
+            return
+
+        for request, image in zip(requests, result):
+            height, width = request.image.shape[:2]
+            request.future.set_result(image[:height, :width])
+
+
+def decode_image(data: str, flags: int) -> np.ndarray:
+    image = cv2.imdecode(np.frombuffer(base64.b64decode(data), dtype=np.uint8), flags)
+    if image is None:
+        raise ValueError("Can not decode the image.")
+    return image
+
+
+def get_handler(batcher: DynamicBatcher, timeout: float = 60):
+    class Handler(BaseHTTPRequestHandler):
+        """POST /inpaint with json {"image": base64 image, "mask": base64 mask, 255 - hole}, returns png."""
+
+        def do_GET(self):  # pylint: disable=C0103
+            if self.path == "/health":
+                self.send(200, b"ok", "text/plain")
+            else:
+                self.send(404, b"Not found", "text/plain")
+
+        def do_POST(self):  # pylint: disable=C0103
+            if self.path != "/inpaint":
+                self.send(404, b"Not found", "text/plain")
+                return
+
+            try:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                image = cv2.cvtColor(decode_image(body["image"], cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+                mask = decode_image(body["mask"], cv2.IMREAD_GRAYSCALE) > 127
+
+                if mask.shape != image.shape[:2]:
+                    raise ValueError("Image and mask have different sizes.")
+            except (KeyError, TypeError, ValueError) as e:  # binascii.Error and JSONDecodeError are ValueError
+                self.send(400, str(e).encode(), "text/plain")
+                return
+
+            try:
+                result = batcher.submit(image, mask).result(timeout)
+            except futures.TimeoutError:
+                self.send(503, b"Timed out waiting for the model", "text/plain")
+                return
+            except Exception as e:  # pylint: disable=W0703
+                self.send(500, str(e).encode(), "text/plain")
+                return
+
+            _, png = cv2.imencode(".png", cv2.cvtColor(result, cv2.COLOR_RGB2BGR))
+            self.send(200, png.tobytes(), "image/png")
+
+        def send(self, code: int, body: bytes, content_type: str) -> None:
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def main():
+    """HTTP server, decode and encode run in the request threads, the model in the batcher thread."""
+    args = get_args()
+
+    with open(args.config_path) as f:
+        config = Adict(yaml.load(f, Loader=yaml.SafeLoader))
+
+    generator = load_generator(config, args.checkpoint_path, args.fuse).to(args.device)
+
+    if args.mode == "cra":
+        model = ContextualResidualAggregation(generator, args.low_resolution)
+        bucket_multiple = 1  # the low resolution size depends on the exact image size
+    else:
+        model = Inpainter(generator)
+        bucket_multiple = generator.patch_size
+
+    batcher = DynamicBatcher(model, args.device, bucket_multiple, args.max_batch_size, args.max_wait / 1000)
+
+    server = ThreadingHTTPServer((args.host, args.port), get_handler(batcher, args.timeout))
+    server.daemon_threads = True
+    print(f"Serving on {args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+from typing import List, Tuple
+
+import torch
+from torch import nn
+
+
+def get_starts(size: int, tile_size: int, stride: int) -> List[int]:
+    """Starts of windows of `tile_size` that cover [0, size), the last window is shifted inside."""
+    if size <= tile_size:
+        return [0]
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+
+class TiledInpainter(nn.Module):
+    """
+    Input: image in range [0, 1] + mask (1 - hole, 0 - non hole), any size
+    Output: image with holes filled by the refinement network
+
+    The generator runs only on windows of `tile_size` with holes, neighbouring windows overlap by `overlap` pixels.
+    Every hole pixel gets the results of all windows that cover it, weighted with linear ramps towards the window
+    sides that have a neighbour. Windows are batched by `max_tiles_per_batch` and moved to the generator device one
+    batch at a time, so the generator memory depends on the tile size only, the image can stay on cpu.
+    """
+
+    def __init__(
+        self, generator: nn.Module, tile_size: int = 512, overlap: int = 128, max_tiles_per_batch: int = 8
+    ) -> None:
+        super().__init__()
+        if not 0 <= overlap < tile_size:
+            raise ValueError(f"overlap should be in [0, tile_size), got {overlap}")
+
+        self.generator = generator
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.max_tiles_per_batch = max_tiles_per_batch
+
+    def forward(self, image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        batch_size, _, height, width = image.shape
+        tile_height = min(self.tile_size, height)
+        tile_width = min(self.tile_size, width)
+        stride = self.tile_size - self.overlap
+
+        windows = [
+            (i, y, x)
+            for i in range(batch_size)
+            for y in get_starts(height, tile_height, stride)
+            for x in get_starts(width, tile_width, stride)
+            if mask[i, :, y : y + tile_height, x : x + tile_width].any()
+        ]
+
+        out = torch.zeros_like(image)
+        weight_sum = torch.zeros_like(mask)
+        device = next(self.generator.parameters()).device
+
+        for start in range(0, len(windows), self.max_tiles_per_batch):
+            batch = windows[start : start + self.max_tiles_per_batch]
+            tiles, tile_masks = self.crop(image, mask, batch, (tile_height, tile_width))
+
+            _, second_out = self.generator(tiles.to(device), tile_masks.to(device))
+            second_out = second_out.to(image.device)
+
+            for (i, y, x), tile in zip(batch, second_out):
+                weight = self.get_weight(y, tile_height, height, image)[:, None]
+                weight = weight * self.get_weight(x, tile_width, width, image)[None]
+
+                out[i, :, y : y + tile_height, x : x + tile_width] += tile * weight
+                weight_sum[i, 0, y : y + tile_height, x : x + tile_width] += weight
+
+        out = out / weight_sum.clamp(min=1e-8)  # zero weight only outside of the holes
+        return image * (1 - mask) + out * mask
+
+    @staticmethod
+    def crop(
+        image: torch.Tensor, mask: torch.Tensor, windows: List[Tuple[int, int, int]], tile: Tuple[int, int]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        tiles = torch.stack([image[i, :, y : y + tile[0], x : x + tile[1]] for i, y, x in windows])
+        tile_masks = torch.stack([mask[i, :, y : y + tile[0], x : x + tile[1]] for i, y, x in windows])
+        return tiles, tile_masks
+
+    def get_weight(self, start: int, length: int, size: int, like: torch.Tensor) -> torch.Tensor:
+        """1D blending weight of a window, ramps from 1 / (overlap + 1) to 1 on the sides with a neighbour."""
+        ramp = torch.arange(1, length + 1, dtype=like.dtype, device=like.device).clamp(max=self.overlap + 1)
+        ramp = ramp / (self.overlap + 1)
+
+        weight = torch.ones_like(ramp)
+        if start > 0:
+            weight = torch.min(weight, ramp)
+        if start + length < size:
+            weight = torch.min(weight, ramp.flip(0))
+
+        return weight
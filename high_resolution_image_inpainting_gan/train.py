@@ -1,7 +1,7 @@
 import argparse
 import os
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 import pytorch_lightning as pl
 import torch
@@ -11,12 +11,32 @@ from albumentations.core.serialization import from_dict
 from iglovikov_helper_functions.config_parsing.utils import object_from_dict
 from pytorch_lightning.loggers import WandbLogger
 from torch import nn
-from torch.utils.data import DataLoader
-
-from high_resolution_image_inpainting_gan.dataset import InpaintDataset
+from torch.utils.data import DataLoader, DistributedSampler
+
+from high_resolution_image_inpainting_gan.curriculum import (
+    get_stage,
+    resize_transform,
+    without_resize,
+)
+from high_resolution_image_inpainting_gan.dataset import (
+    IMAGE_EXTENSIONS,
+    BucketDataset,
+    InpaintDataset,
+    ShardDataset,
+)
+from high_resolution_image_inpainting_gan.device_aug import split_transform
+from high_resolution_image_inpainting_gan.image_index import ImageIndex
 from high_resolution_image_inpainting_gan.losses import Hinge, Perceptual
-
-image_path = Path(os.environ["IMAGE_PATH"])
+from high_resolution_image_inpainting_gan.masks import StrokeMaskGenerator
+from high_resolution_image_inpainting_gan.metrics import compute_metrics
+from high_resolution_image_inpainting_gan.profiling import BlockProfiler
+from high_resolution_image_inpainting_gan.samplers import (
+    AspectRatioBatchSampler,
+    EpochSampler,
+    ResumableSampler,
+    get_bucket_shapes,
+    get_buckets,
+)
 
 
 def get_args():
@@ -36,26 +56,119 @@ class Inpainting(pl.LightningModule):
         self.perceptual = Perceptual()
         self.losses = {"l1": nn.L1Loss(), "hinge": Hinge()}
 
+        if "mask_generator" in self.config and "mask_bank" in self.config:
+            raise ValueError("Config should have either mask_generator or mask_bank, not both.")
+
+        if "mask_generator" in self.config:  # masks are generated for the whole batch on the training device
+            self.mask_generator = object_from_dict(self.config["mask_generator"])
+        else:
+            self.mask_generator = None
+
+        if "mask_bank" in self.config:  # pre-generated masks, see mask_bank.py
+            self.mask_bank = object_from_dict(self.config["mask_bank"])
+        else:
+            self.mask_bank = None
+
+        if "block_profiler" in self.config:  # time and memory of the generator and discriminator blocks
+            self.block_profiler = BlockProfiler(self.generator, self.discriminator, **self.config.block_profiler)
+        else:
+            self.block_profiler = None
+
+        if self.config.train_parameters.get("device_aug", False):  # workers return uint8 images, see device_aug.py
+            self.train_aug_config, self.device_aug = split_transform(self.config.train_aug)
+        else:
+            self.train_aug_config, self.device_aug = self.config.train_aug, None
+
+        self.fake_images: Optional[torch.Tensor] = None  # detached generator output for the discriminator step
+
+        # images and masks of the batch, computed in the generator step and reused in the discriminator step
+        self.batch_key: Optional[Tuple[int, int]] = None
+        self.batch_inputs: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+
+        # position of the train sampler, saved in the checkpoint to resume in the middle of an epoch
+        self.train_sampler: Optional[EpochSampler] = None
+        self.sampler_state: Optional[Dict[str, int]] = None
+
     def forward(self, batch: Dict[str, torch.Tensor]) -> torch.Tensor:  # type: ignore
         return self.generator(**batch)
 
     def setup(self, stage=0):  # pylint: disable=W0613
-        self.image_paths = sorted(image_path.rglob("*.jpg"))
+        if "val_parameters" in self.config:
+            val_image_path = Path(os.environ["VAL_IMAGE_PATH"])
+            self.val_image_paths = sorted(x for x in val_image_path.rglob("*") if x.suffix.lower() in IMAGE_EXTENSIONS)
+            print("Len val images = ", len(self.val_image_paths))
+
+        train_parameters = self.config.train_parameters
+
+        if "aspect_ratio_buckets" in train_parameters and "image_index" not in train_parameters:
+            raise ValueError("aspect_ratio_buckets requires image_index in train_parameters.")
+
+        if "aspect_ratio_buckets" in train_parameters and "epoch_length" in train_parameters:
+            raise ValueError("epoch_length is not supported with aspect_ratio_buckets, an epoch is all full batches.")
+
+        if "aspect_ratio_buckets" in train_parameters and "shard_path" in train_parameters:
+            raise ValueError(
+                "aspect_ratio_buckets can not be used with shard_path, buckets are read from image_index."
+            )
+
+        if "shard_path" in train_parameters:  # images packed by pack_shards.py
+            return
+
+        image_path = Path(os.environ["IMAGE_PATH"])
+
+        if "image_index" in train_parameters:  # built by image_index.py, the folder is not listed
+            self.image_index = ImageIndex.load(train_parameters.image_index)
+            self.image_paths = self.image_index.image_paths(image_path)
+        else:
+            self.image_paths = sorted(x for x in image_path.rglob("*") if x.suffix.lower() in IMAGE_EXTENSIONS)
+
         print("Len train images = ", len(self.image_paths))
 
     def train_dataloader(self):
-        train_aug = from_dict(self.config.train_aug)
+        # with a curriculum the dataloader is rebuilt every epoch, see curriculum.py
+        stage = get_stage(self.config.get("curriculum", []), self.current_epoch)
+
+        if stage is None:
+            train_aug = from_dict(self.train_aug_config)
+            batch_size = self.config.train_parameters.batch_size
+        else:
+            train_aug = from_dict(resize_transform(self.train_aug_config, stage["size"]))
+            batch_size = stage["batch_size"]
+            print(f"Epoch {self.current_epoch}: size = {stage['size']}, batch size = {batch_size}")
 
         if "epoch_length" not in self.config.train_parameters:
             epoch_length = None
         else:
             epoch_length = self.config.train_parameters.epoch_length
 
+        mask_parameters = {"generate_mask": self.mask_generator is None, "mask_bank": self.mask_bank}
+
+        if "aspect_ratio_buckets" in self.config.train_parameters:
+            result = self.get_bucket_dataloader(batch_size, None if stage is None else stage["size"])
+            print("Train dataloader = ", len(result))
+            return result
+
+        if "shard_path" in self.config.train_parameters:
+            dataset = ShardDataset(Path(self.config.train_parameters.shard_path), train_aug, **mask_parameters)
+        else:
+            dataset = InpaintDataset(self.image_paths, train_aug, **mask_parameters)
+
+        # samples are split between the ranks by the sampler, the trainer does not replace it
+        self.train_sampler = ResumableSampler(
+            len(dataset),
+            batch_size,
+            epoch_length,
+            seed=self.config.seed,
+            num_replicas=self.trainer.world_size,
+            rank=self.global_rank,
+        )
+        self.train_sampler.load_state_dict(self.sampler_state)
+
         result = DataLoader(
-            InpaintDataset(self.image_paths, train_aug, epoch_length),
-            batch_size=self.config.train_parameters.batch_size,
+            dataset,
+            batch_size=batch_size,
+            sampler=self.train_sampler,
             num_workers=self.config.num_workers,
-            shuffle=True,
             pin_memory=True,
             drop_last=True,
         )
@@ -63,6 +176,66 @@ class Inpainting(pl.LightningModule):
         print("Train dataloader = ", len(result))
         return result
 
+    def get_bucket_dataloader(self, batch_size: int, size: Optional[int] = None) -> DataLoader:
+        """Batches of images with similar aspect ratios, cropped to the shape of their bucket instead of a square."""
+        buckets_config = self.config.train_parameters.aspect_ratio_buckets
+        shapes = get_bucket_shapes(size or buckets_config.size, buckets_config.aspect_ratios)
+        buckets = get_buckets(self.image_index.aspect_ratios, shapes)
+
+        dataset = BucketDataset(
+            self.image_paths,
+            from_dict(without_resize(self.train_aug_config)),
+            shapes,
+            buckets,
+            generate_mask=self.mask_generator is None,
+            mask_bank=self.mask_bank,
+        )
+
+        # batches are split between the ranks by the sampler, the trainer does not replace it
+        self.train_sampler = AspectRatioBatchSampler(
+            buckets,
+            batch_size,
+            seed=self.config.seed,
+            num_replicas=self.trainer.world_size,
+            rank=self.global_rank,
+        )
+        self.train_sampler.load_state_dict(self.sampler_state)
+
+        return DataLoader(
+            dataset, batch_sampler=self.train_sampler, num_workers=self.config.num_workers, pin_memory=True
+        )
+
+    def val_dataloader(self):
+        if "val_parameters" not in self.config:  # no validation
+            return []
+
+        # the same masks every epoch: the evaluation subset of the mask bank or generated with a fixed seed
+        use_mask_bank = self.mask_bank is not None and self.mask_bank.num_eval > 0
+        dataset = InpaintDataset(
+            self.val_image_paths,
+            from_dict(self.config.val_aug),
+            generate_mask=use_mask_bank,
+            mask_bank=self.mask_bank,
+            evaluation=True,
+        )
+
+        if self.trainer.world_size > 1:  # the trainer does not add a distributed sampler
+            sampler = DistributedSampler(
+                dataset, num_replicas=self.trainer.world_size, rank=self.global_rank, shuffle=False
+            )
+        else:
+            sampler = None
+
+        return DataLoader(
+            dataset,
+            batch_size=self.config.val_parameters.batch_size,
+            sampler=sampler,
+            num_workers=self.config.num_workers,
+            shuffle=False,
+            pin_memory=True,
+            drop_last=False,
+        )
+
     def configure_optimizers(self):
         optimizer_generator = object_from_dict(
             self.config["optimizer_generator"],
@@ -83,22 +256,56 @@ class Inpainting(pl.LightningModule):
 
         return self.optimizers, [scheduler_generator, scheduler_discriminator]
 
-    def training_step(self, batch, batch_idx, optimizer_idx):  # pylint: disable=W0613, R1710
+    def get_masks(self, batch: Dict[str, torch.Tensor], batch_idx: int, evaluation: bool = False) -> torch.Tensor:
+        if "mask" in batch:
+            return batch["mask"]
+
         images = batch["image"]
-        masks = batch["mask"]
+        generator = torch.Generator(device=images.device)
+
+        if evaluation:  # the same masks every epoch
+            generator.manual_seed(hash((self.config.seed, batch_idx)))
+        else:  # generator and discriminator steps of the batch should get the same masks
+            generator.manual_seed(hash((self.config.seed, self.global_rank, self.current_epoch, batch_idx)))
+
+        mask_generator = self.mask_generator or StrokeMaskGenerator()
+        return mask_generator(images.shape[0], images.shape[2], images.shape[3], images.device, generator)
+
+    def get_images(self, batch: Dict[str, torch.Tensor], batch_idx: int) -> torch.Tensor:
+        if self.device_aug is None:
+            return batch["image"]
 
+        # generator and discriminator steps of the batch should get the same augmentations, not correlated with masks
+        generator = torch.Generator(device=batch["image"].device)
+        generator.manual_seed(hash((self.config.seed, self.global_rank, self.current_epoch, batch_idx, 1)))
+        return self.device_aug(batch["image"], generator)
+
+    def get_inputs(self, batch: Dict[str, torch.Tensor], batch_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Augmented images and masks of the batch, generated once for both optimizer steps."""
+        key = (self.current_epoch, batch_idx)
+        if self.batch_key != key or self.batch_inputs is None:
+            self.batch_key = key
+            self.batch_inputs = self.get_images(batch, batch_idx), self.get_masks(batch, batch_idx)
+        return self.batch_inputs
+
+    def update_discriminator(self, batch_idx: int) -> bool:
+        return batch_idx % self.config.train_parameters.get("discriminator_update_every", 1) == 0
+
+    def training_step(self, batch, batch_idx, optimizer_idx):  # pylint: disable=W0613, R1710
         if optimizer_idx == 0:  # train generator
+            images, masks = self.get_inputs(batch, batch_idx)
+
             # Generator output
             first_out, second_out = self.generator(images, masks)
 
             first_out_whole_image = images * (1 - masks) + first_out * masks  # in range [0, 1]
-            self.second_out_whole_image = images * (1 - masks) + second_out * masks  # in range [0, 1]
+            second_out_whole_image = images * (1 - masks) + second_out * masks  # in range [0, 1]
 
             first_mask_l1_loss = self.losses["l1"](first_out_whole_image, images)
-            second_mask_l1_loss = self.losses["l1"](self.second_out_whole_image, images)
-            perceptual_loss = self.perceptual(self.second_out_whole_image, images)
+            second_mask_l1_loss = self.losses["l1"](second_out_whole_image, images)
+            perceptual_loss = self.perceptual(images, second_out_whole_image)
 
-            fake_scalar = self.discriminator(self.second_out_whole_image, masks)
+            fake_scalar = self.discriminator(second_out_whole_image, masks)
             gan_loss = -torch.mean(fake_scalar)
 
             total_loss = (
@@ -108,22 +315,80 @@ class Inpainting(pl.LightningModule):
                 + self.config.loss_weights["gan"] * gan_loss
             )
 
-            self.log("first_mask_l1", first_mask_l1_loss, on_step=True, on_epoch=False, logger=True, prog_bar=True)
-            self.log("second_mask_l1", second_mask_l1_loss, on_step=True, on_epoch=False, logger=True, prog_bar=True)
-            self.log("gan", gan_loss, on_step=True, on_epoch=False, logger=True, prog_bar=True)
-            self.log("perceptual", perceptual_loss, on_step=True, on_epoch=False, logger=True, prog_bar=True)
-            self.log("total_loss", total_loss, on_step=True, on_epoch=False, logger=True, prog_bar=True)
+            if self.update_discriminator(batch_idx):
+                # detached, so the generator graph is not kept alive until the discriminator step
+                self.fake_images = second_out_whole_image.detach()
+            else:
+                self.batch_inputs = None
+
+            # detached, so the logged values do not keep the graph of the step alive
+            losses = {
+                "first_mask_l1": first_mask_l1_loss,
+                "second_mask_l1": second_mask_l1_loss,
+                "gan": gan_loss,
+                "perceptual": perceptual_loss,
+                "total_loss": total_loss,
+            }
+            self.log_dict(
+                {name: value.detach() for name, value in losses.items()},
+                on_step=True,
+                on_epoch=False,
+                logger=True,
+                prog_bar=True,
+            )
 
             return total_loss
 
-        if optimizer_idx == 1:  # train discriminator
-            fake_scalar = self.discriminator(self.second_out_whole_image.detach(), masks)
-            true_scalar = self.discriminator(images, masks)
+        if optimizer_idx == 1 and self.update_discriminator(batch_idx):  # train discriminator
+            fake_images, self.fake_images = self.fake_images, None
+            images, masks = self.get_inputs(batch, batch_idx)
+            self.batch_inputs = None
+
+            # fake and real images in a single forward
+            scalar = self.discriminator(torch.cat([fake_images, images]), torch.cat([masks, masks]))
+            fake_scalar, true_scalar = torch.split(scalar, images.shape[0])
+
             loss_discriminator = self.losses["hinge"](true_scalar, fake_scalar)
-            self.log("discriminator", loss_discriminator, on_step=True, on_epoch=False, logger=True, prog_bar=True)
+            self.log(
+                "discriminator", loss_discriminator.detach(), on_step=True, on_epoch=False, logger=True, prog_bar=True
+            )
 
             return loss_discriminator
 
+    def validation_step(self, batch, batch_idx):  # pylint: disable=W0613
+        images = batch["image"]
+        masks = self.get_masks(batch, batch_idx, evaluation=True)
+
+        _, second_out = self.generator(images, masks)
+        second_out_whole_image = images * (1 - masks) + second_out * masks
+
+        metrics = compute_metrics(second_out_whole_image, images, masks, self.perceptual.extractor)
+        self.log_dict(
+            {f"val_{name}": value.mean() for name, value in metrics.items()},
+            on_step=False,
+            on_epoch=True,
+            logger=True,
+            sync_dist=True,
+        )
+
+    def on_train_batch_end(self, outputs, batch, batch_idx, dataloader_idx):  # pylint: disable=W0613
+        if self.train_sampler is not None:
+            self.sampler_state = self.train_sampler.state_dict(batch_idx + 1)
+
+        if self.block_profiler is not None and self.block_profiler.step():
+            print(self.block_profiler.table())
+            self.logger.log_metrics(self.block_profiler.metrics(), step=self.global_step)
+
+    def on_save_checkpoint(self, checkpoint: Dict) -> None:
+        # the same position on all ranks, every rank gets the same number of batches
+        checkpoint["sampler_state"] = self.sampler_state
+
+    def on_load_checkpoint(self, checkpoint: Dict) -> None:
+        self.sampler_state = checkpoint.get("sampler_state")
+
+        if self.train_sampler is not None:
+            self.train_sampler.load_state_dict(self.sampler_state)
+
     def _get_current_lr(self) -> torch.Tensor:
         lr = [x["lr"] for x in self.optimizers[0].param_groups][0]  # type: ignore
         return torch.Tensor([lr])[0].cuda()
@@ -144,6 +409,8 @@ def main():
         config["trainer"],
         logger=WandbLogger(config["experiment_name"]),
         checkpoint_callback=object_from_dict(config["checkpoint_callback"]),
+        reload_dataloaders_every_epoch="curriculum" in config,
+        replace_sampler_ddp=False,  # train samplers shard the data between the ranks, see samplers.py
     )
 
     trainer.fit(pipeline)
@@ -0,0 +1,99 @@
+import pytest
+import torch
+from torch.nn import functional as F
+
+from high_resolution_image_inpainting_gan.inpainting_network import (
+    ContextualAttention,
+    GatedGenerator,
+    PatchDiscriminator,
+)
+
+
+def get_features(discriminator: PatchDiscriminator, image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    x = torch.cat((image, mask), 1)
+    for i in range(1, 7):
+        x = getattr(discriminator, f"block{i}")(x)
+    return x
+
+
+@pytest.mark.parametrize(
+    "height, width", [(128, 128), (256, 256), (384, 384), (256, 1024), (512, 512), (768, 768), (640, 384)]
+)
+def test_discriminator_patches_have_equal_weights(height: int, width: int) -> None:
+    torch.manual_seed(0)
+    discriminator = PatchDiscriminator().eval()
+    with torch.no_grad():
+        discriminator.block7.weight.fill_(1)
+        discriminator.block7.bias.zero_()
+
+    image, mask = torch.rand(2, 3, height, width), torch.zeros(2, 1, height, width)
+
+    with torch.no_grad():
+        features = get_features(discriminator, image, mask)
+        output = discriminator(image, mask)
+
+    # every patch of the map is weighted equally
+    expected = features.sum(dim=1).mean(dim=(1, 2))[:, None] * 64
+    assert torch.allclose(output, expected, atol=1e-4)
+
+
+def test_discriminator_512() -> None:
+    torch.manual_seed(0)
+    discriminator = PatchDiscriminator().eval()
+    image, mask = torch.rand(2, 3, 512, 512), torch.zeros(2, 1, 512, 512)
+
+    with torch.no_grad():
+        features = get_features(discriminator, image, mask)
+        assert torch.equal(discriminator(image, mask), discriminator.block7(features.reshape(2, -1)))
+
+
+def test_chunked_attention_matches_dense() -> None:
+    torch.manual_seed(0)
+    feature = torch.randn(2, 128, 12, 20)  # 96 x 160 input, non square
+    patch_fb = torch.zeros(2, 1, 6, 10)
+    patch_fb[0, :, 1:3, 2:6] = 1
+    patch_fb[1, :, 0:2, 8:10] = 1  # at the border
+    patch_fb[1, :, 4:6, 0:3] = 1
+    values = [torch.randn(2, 128, 12, 20), torch.randn(2, 64, 24, 40), torch.randn(2, 32, 48, 80)]
+
+    dense = ContextualAttention()(feature, patch_fb, values)
+    chunked = ContextualAttention(memory_budget=1)(feature, patch_fb, values)
+
+    for x, y in zip(chunked, dense):
+        assert torch.allclose(x, y, atol=1e-5)
+
+
+def test_decode_tiles_matches_full_decode() -> None:
+    torch.manual_seed(0)
+    generator = GatedGenerator("none", "elu").eval()
+    sparse_generator = GatedGenerator("none", "elu", sparse_tile_size=32).eval()
+    sparse_generator.load_state_dict(generator.state_dict())
+
+    height, width = 256, 384
+    image = torch.rand(1, 3, height, width)
+    mask = torch.zeros(1, 1, height, width)
+    mask[:, :, :20, :20] = 1  # corner
+    mask[:, :, 100:140, 150:190] = 1
+    mask[:, :, 230:, 300:340] = 1  # bottom border
+
+    decode_shapes = []
+
+    def decode(*features: torch.Tensor) -> torch.Tensor:
+        decode_shapes.append(features[0].shape)
+        return GatedGenerator.decode(sparse_generator, *features)
+
+    sparse_generator.decode = decode  # type: ignore
+
+    with torch.no_grad():
+        _, expected = generator(image, mask)
+        _, second_out = sparse_generator(image, mask)
+
+    assert decode_shapes and all(x[2:] == (12, 12) for x in decode_shapes)  # 96 x 96 windows, not the full image
+
+    hole = mask.bool().expand_as(second_out)
+    assert torch.allclose(second_out[hole], expected[hole], atol=1e-5)
+
+    # outside the tiles with holes the output is the input image
+    hole_tiles = F.interpolate(F.max_pool2d(mask, 32, ceil_mode=True), scale_factor=32)[:, :, :height, :width]
+    outside = ~hole_tiles.bool().expand_as(second_out)
+    assert torch.equal(second_out[outside], image[outside])
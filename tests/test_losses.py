@@ -0,0 +1,40 @@
+from typing import List
+
+import pytest
+import torch
+from torchvision import models
+
+from high_resolution_image_inpainting_gan.losses import Perceptual
+
+
+@pytest.fixture
+def perceptual(monkeypatch) -> Perceptual:
+    vgg16 = models.vgg16
+    monkeypatch.setattr(models, "vgg16", lambda pretrained: vgg16())  # random weights, no download
+    return Perceptual()
+
+
+def test_perceptual_target_without_graph(perceptual: Perceptual) -> None:
+    batch_sizes: List[int] = []
+    perceptual.extractor.register_forward_pre_hook(lambda module, inputs: batch_sizes.append(len(inputs[0])))
+
+    target_features: List[torch.Tensor] = []
+    get_target_features = perceptual.get_target_features
+
+    def record_target_features(y_true: torch.Tensor) -> List[torch.Tensor]:
+        target_features.extend(get_target_features(y_true))
+        return target_features
+
+    perceptual.get_target_features = record_target_features  # type: ignore
+
+    target = torch.rand(2, 3, 32, 32)
+    weight = torch.ones(1, requires_grad=True)
+    prediction = torch.rand(2, 3, 32, 32) * weight
+
+    loss = perceptual(target, prediction)
+    loss.backward()
+
+    assert batch_sizes == [2, 2]  # prediction and target separately, not in one batch
+    assert target_features
+    assert all(x.grad_fn is None and not x.requires_grad for x in target_features)
+    assert weight.grad is not None
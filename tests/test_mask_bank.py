@@ -0,0 +1,28 @@
+import sys
+
+import numpy as np
+import torch
+
+from high_resolution_image_inpainting_gan import mask_bank
+from high_resolution_image_inpainting_gan.masks import StrokeMaskGenerator
+
+
+def test_mask_bank(tmp_path, monkeypatch) -> None:
+    output_path = tmp_path / "masks.npy"
+    arguments = ["mask_bank", "-o", str(output_path), "-n", "80", "-s", "512", "-b", "72", "--device", "cpu"]
+    monkeypatch.setattr(sys, "argv", arguments)
+    mask_bank.main()
+
+    bank = np.load(output_path)
+    assert bank.shape == (80, 512, 64)
+
+    # the default seed of mask_bank.py, the stored batch is the same as its masks generated one at a time
+    generator = torch.Generator()
+    generator.manual_seed(1984)
+    mask_generator = StrokeMaskGenerator()
+    segments, batch_indices = mask_generator.sample_segments(72, 512, 512, generator=generator)
+
+    for i in [0, 71]:
+        selected = batch_indices == i
+        mask = mask_generator.draw(segments[selected], torch.zeros(int(selected.sum()), dtype=torch.long), 1, 512, 512)
+        assert np.array_equal(np.unpackbits(bank[i], axis=-1), mask[0, 0].numpy().astype(np.uint8))
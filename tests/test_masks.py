@@ -0,0 +1,36 @@
+import pytest
+import torch
+
+from high_resolution_image_inpainting_gan.masks import StrokeMaskGenerator
+
+
+@pytest.mark.parametrize("parameters", [{"max_vertex": 0}, {"parts": 0}, {"parts": 1, "max_vertex": 1}])
+def test_no_strokes(parameters) -> None:
+    mask_generator = StrokeMaskGenerator(**parameters)
+    for seed in range(8):  # with a single vertex at most, some batches have no strokes
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        masks = mask_generator(2, 32, 32, generator=generator)
+        assert masks.shape == (2, 1, 32, 32)
+
+
+def test_invalid_parameters() -> None:
+    with pytest.raises(ValueError):
+        StrokeMaskGenerator(max_vertex=-1)
+    with pytest.raises(ValueError):
+        StrokeMaskGenerator(max_brush_width=5)
+
+
+def test_large_batch() -> None:
+    # 72 x 512 x 512 pixels, more than 2 ** 24, the last masks are not exact with a float32 flat index
+    mask_generator = StrokeMaskGenerator()
+    generator = torch.Generator()
+    generator.manual_seed(0)
+
+    segments, batch_indices = mask_generator.sample_segments(72, 512, 512, generator=generator)
+    masks = mask_generator.draw(segments, batch_indices, 72, 512, 512)
+
+    last = batch_indices == 71
+    expected = mask_generator.draw(segments[last], torch.zeros(int(last.sum()), dtype=torch.long), 1, 512, 512)
+    assert expected.sum() > 0
+    assert torch.equal(masks[-1:], expected)
@@ -0,0 +1,41 @@
+import copy
+
+import pytest
+import torch
+
+from high_resolution_image_inpainting_gan.inpainting_network import GatedGenerator
+from high_resolution_image_inpainting_gan.network_module import (
+    FusedGatedConv2d,
+    GatedConv2d,
+    fuse_gated_conv2d,
+)
+
+
+@pytest.mark.parametrize("activation", ["elu", "relu", "lrelu", "none", "tanh"])
+@pytest.mark.parametrize("single_channel_conv", [False, True])
+def test_fused_gated_conv2d(activation: str, single_channel_conv: bool) -> None:
+    torch.manual_seed(0)
+    gated_conv = GatedConv2d(
+        8, 16, 3, 1, 2, 2, "replicate", activation, single_channel_conv=single_channel_conv
+    ).eval()
+    fused_conv = FusedGatedConv2d(copy.deepcopy(gated_conv)).eval()
+
+    x = torch.randn(2, 8, 20, 24)
+    with torch.no_grad():
+        assert torch.allclose(fused_conv(x), gated_conv(x), atol=1e-6)
+
+
+def test_fuse_gated_generator() -> None:
+    torch.manual_seed(0)
+    generator = GatedGenerator("none", "elu").eval()
+    fused_generator = fuse_gated_conv2d(copy.deepcopy(generator)).eval()
+
+    assert not any(isinstance(x, GatedConv2d) for x in fused_generator.modules())
+
+    image = torch.rand(1, 3, 128, 128)
+    mask = torch.zeros(1, 1, 128, 128)
+    mask[:, :, 32:80, 40:96] = 1
+
+    with torch.no_grad():
+        for fused, reference in zip(fused_generator(image, mask), generator(image, mask)):
+            assert torch.allclose(fused, reference, atol=1e-5)
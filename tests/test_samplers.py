@@ -0,0 +1,49 @@
+import numpy as np
+
+from high_resolution_image_inpainting_gan.samplers import (
+    AspectRatioBatchSampler,
+    ResumableSampler,
+)
+
+
+def test_resume_in_the_middle_of_an_epoch() -> None:
+    sampler = ResumableSampler(110, 8, seed=1)
+    items = list(sampler)
+    state = sampler.state_dict(5)
+
+    resumed = ResumableSampler(110, 8, seed=1)
+    resumed.load_state_dict(state)
+    assert list(resumed) == items[5 * 8 :]
+
+
+def test_finished_epoch_with_another_batch_size() -> None:
+    # the end of an epoch of a curriculum stage with batch size 32, the next stage has batch size 8
+    sampler = ResumableSampler(110, 32)
+    items = list(sampler)
+    state = sampler.state_dict(len(items) // 32)
+
+    next_stage = ResumableSampler(110, 8)
+    next_stage.load_state_dict(state)
+    assert len(list(next_stage)) == len(next_stage) == 104
+    assert next_stage.current == (1, 0)
+
+
+def test_unfinished_epoch_with_another_batch_size() -> None:
+    sampler = ResumableSampler(110, 32)
+    list(sampler)
+
+    next_stage = ResumableSampler(110, 8)
+    next_stage.load_state_dict(sampler.state_dict(1))
+    assert len(list(next_stage)) == 104  # a fresh epoch, positions of another batch size are not comparable
+    assert next_stage.current == (1, 0)
+
+
+def test_aspect_ratio_batches_with_another_batch_size() -> None:
+    buckets = np.arange(100) % 3
+    sampler = AspectRatioBatchSampler(buckets, 16)
+    batches = list(sampler)
+    state = sampler.state_dict(len(batches))
+
+    next_stage = AspectRatioBatchSampler(buckets, 4)
+    next_stage.load_state_dict(state)
+    assert len(list(next_stage)) == len(next_stage)
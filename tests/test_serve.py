@@ -0,0 +1,68 @@
+import base64
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from high_resolution_image_inpainting_gan.serve import DynamicBatcher, get_handler
+
+
+class Model(nn.Module):
+    """Fails on the first batch, returns the images after that, every batch takes `delay` seconds."""
+
+    def __init__(self, delay: float = 0) -> None:
+        super().__init__()
+        self.delay = delay
+        self.num_batches = 0
+
+    def forward(self, image: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:  # pylint: disable=W0613
+        self.num_batches += 1
+        time.sleep(self.delay)
+        if self.num_batches == 1:
+            raise ValueError("bad batch")
+        return image
+
+
+def get_request(height: int = 16, width: int = 16):
+    return np.full((height, width, 3), 128, dtype=np.uint8), np.zeros((height, width), dtype=bool)
+
+
+def test_batcher_survives_exceptions() -> None:
+    batcher = DynamicBatcher(Model(), "cpu", 1, max_batch_size=1, max_wait=0)
+
+    with pytest.raises(ValueError):
+        batcher.submit(*get_request()).result(5)
+
+    image, mask = get_request()
+    assert np.array_equal(batcher.submit(image, mask).result(5), image)
+
+
+def test_handler_timeout() -> None:
+    batcher = DynamicBatcher(Model(delay=1), "cpu", 1, max_batch_size=1, max_wait=0)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), get_handler(batcher, timeout=0.1))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    image, mask = get_request()
+    body = {
+        "image": base64.b64encode(cv2.imencode(".png", image)[1].tobytes()).decode(),
+        "mask": base64.b64encode(cv2.imencode(".png", mask.astype(np.uint8) * 255)[1].tobytes()).decode(),
+    }
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{server.server_address[1]}/inpaint", data=json.dumps(body).encode(), method="POST"
+    )
+
+    try:
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(request, timeout=5)  # nosec
+        assert e.value.code == 503
+    finally:
+        server.shutdown()
+        server.server_close()